@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for the output normalization of
+`EllipsisOutputChecker.check_output`: Checks large outputs, as read
+from a process, against matching expected outputs, by decoding and
+normalizing every stage unconditionally (as scriptdoctest 0.3 did),
+by decoding and checking the text, and by checking the bytes.
+
+    python benchmarks/bench_normalize.py [--size MB] [--repeat N]
+"""
+
+import argparse
+import doctest
+import os
+import sys
+import timeit
+import unicodedata
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from scriptdoctest import EllipsisOutputChecker, WantMatcher, ansi_escape  # noqa
+
+
+def full_normalize(want, got):
+    """The normalization of scriptdoctest 0.3, for comparison."""
+    got = ansi_escape.sub("", got)
+    got = unicodedata.normalize("NFC", got)
+    got = got.replace("\t", "    ")
+    got = "\n".join(line.rsplit("\r", 1)[-1] for line in got.split("\n"))
+    want = ansi_escape.sub("", want)
+    want = unicodedata.normalize("NFC", want)
+    want = want.replace("\t", "    ")
+    return got == want
+
+
+def outputs(size):
+    """Return pairs of a name and an output of about `size` bytes."""
+    ascii_line = "%08d some ordinary ASCII output of a command\n"
+    unicode_line = "%08d Ausgabe mit Umlauten: äöü und ß\n"
+    n = size // len(ascii_line % 0)
+    yield "ascii", "".join(ascii_line % i for i in range(n))
+    yield "unicode", "".join(unicode_line % i for i in range(n))
+    yield "ansi", "".join("\x1b[1m" + ascii_line % i for i in range(n))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--size", type=float, default=8, help="output size in MB")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(args)
+
+    checker = EllipsisOutputChecker()
+    flags = doctest.ELLIPSIS
+    print("%-8s %12s %12s %12s" % ("output", "0.3 [ms]", "text [ms]", "bytes [ms]"))
+    for name, text in outputs(int(args.size * (1 << 20))):
+        want = ansi_escape.sub("", text)
+        matcher = WantMatcher(want)
+        data = text.encode("utf-8")
+        assert full_normalize(want, text)
+        assert checker.check_output(matcher, text, flags)
+        assert checker.check_output(matcher, data, flags)
+        timings = [
+            min(timeit.repeat(check, number=1, repeat=args.repeat)) * 1000
+            for check in (
+                lambda: full_normalize(want, data.decode("utf-8")),
+                lambda: checker.check_output(matcher, data.decode("utf-8"), flags),
+                lambda: checker.check_output(matcher, data, flags),
+            )
+        ]
+        print("%-8s %12.1f %12.1f %12.1f" % ((name,) + tuple(timings)))
+
+
+if __name__ == "__main__":
+    main()
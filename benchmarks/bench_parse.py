@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Parse throughput of `ScriptDocTestParser`, and of the parser with the
+original, backtracking `_EXAMPLE_RE`, on a large generated document,
+and on a file construction that lacks its file name, which makes the
+original regular expression backtrack exponentially in the number of
+its lines. tests/test_parser.py checks that both find the same
+examples.
+
+    python benchmarks/bench_parse.py [--size MB] [--lines N] [--repeat N]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tests"))
+
+from scriptdoctest import ScriptDocTestParser  # noqa
+from test_parser import BacktrackingParser, document, unnamed_file  # noqa
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--size", type=float, default=4, help="document size in MB")
+    parser.add_argument(
+        "--lines", type=int, default=8, help="lines of the unnamed file"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(args)
+
+    documents = [
+        ("reference", document(int(args.size * (1 << 20)))),
+        ("unnamed", unnamed_file(args.lines)),
+    ]
+    parsers = [("current", ScriptDocTestParser()), ("original", BacktrackingParser())]
+    print("%-10s %-8s %10s %10s" % ("document", "parser", "time [s]", "MB/s"))
+    for doc, string in documents:
+        # Alternate the parsers, so that both see the same conditions.
+        elapsed = [float("inf")] * len(parsers)
+        for _ in range(args.repeat):
+            for i, (name, p) in enumerate(parsers):
+                gc.collect()
+                start = time.perf_counter()
+                p.parse(string, "<bench>")
+                elapsed[i] = min(elapsed[i], time.perf_counter() - start)
+        for (name, p), seconds in zip(parsers, elapsed):
+            print(
+                "%-10s %-8s %10.4f %10.1f"
+                % (doc, name, seconds, len(string) / seconds / (1 << 20))
+            )
+
+
+if __name__ == "__main__":
+    main()
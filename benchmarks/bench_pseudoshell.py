@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for the commands `PSEUDOSHELL` runs in Python: Runs
+common file commands in a workspace through /bin/sh and through
+`PseudoShell`, checks that both give the same output and leave the
+same files, and compares their times.
+
+    python benchmarks/bench_pseudoshell.py [--repeat N]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import scripttest  # noqa
+from scriptdoctest import PseudoShell  # noqa
+
+COMMANDS = [
+    "echo hello world",
+    "echo -n no newline",
+    "echo 'quoted  spaces'  # a comment",
+    "echo -e 'falls back'",
+    "pwd",
+    "ls",
+    "ls -a",
+    "ls -A",
+    "ls -1 sub",
+    "ls sub file.txt",
+    "ls sub other",
+    "ls file.txt Zfile .hidden",
+    "ls missing",
+    "ls -l",
+    "cat file.txt",
+    "cat file.txt sub/nested.txt",
+    "cat missing",
+    "cat sub",
+    "mkdir new",
+    "mkdir -p a/b/c",
+    "mkdir -p sub",
+    "mkdir sub",
+    "mkdir x/y",
+    "mkdir n1 n1",
+    "mkdir -p sub/../new",
+    "touch file.txt new.txt",
+    "touch nodir/new.txt",
+    "rm file.txt",
+    "rm -f missing file.txt",
+    "rm missing",
+    "rm sub",
+    "rm -r sub",
+    "rm -rf other sub",
+    "rm -r other/../sub",
+    "rm -i file.txt",
+]
+
+
+def fixture(path):
+    """Fill the directory `path` with some files."""
+    os.makedirs(os.path.join(path, "sub"))
+    os.makedirs(os.path.join(path, "other", "deeper"))
+    for name, content in [
+        ("file.txt", "some text\n"),
+        ("Zfile", "Z\n"),
+        (".hidden", ""),
+        ("sub/nested.txt", "nested\n"),
+        ("sub/B", ""),
+        ("sub/a", ""),
+    ]:
+        with open(os.path.join(path, name), "w") as f:
+            f.write(content)
+
+
+def tree(path):
+    """Return the files and directories below `path`."""
+    return sorted(
+        os.path.relpath(os.path.join(dirpath, name), path)
+        for dirpath, dirnames, filenames in os.walk(path)
+        for name in dirnames + filenames
+    )
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(args)
+
+    tmp = tempfile.mkdtemp(prefix="scriptdoctest-bench-")
+    environ = dict(os.environ, LC_ALL="C")
+    try:
+        print("%-32s %12s %12s" % ("command", "sh [ms]", "python [ms]"))
+        for command in COMMANDS:
+            real = os.path.join(tmp, "real")
+            fixture(real)
+            env = scripttest.TestFileEnvironment(
+                real, environ=dict(environ), snapshot=False, start_clear=False
+            )
+            start = time.perf_counter()
+            expected = env.run("/bin/sh", "-c", command, expect_error=True, err_to_out=True)
+            sh = time.perf_counter() - start
+
+            pseudo = os.path.join(tmp, "pseudo")
+            fixture(pseudo)
+            env = scripttest.TestFileEnvironment(
+                pseudo, environ=dict(environ), snapshot=False, start_clear=False
+            )
+            start = time.perf_counter()
+            got = PseudoShell(env).run(command)
+            python = time.perf_counter() - start
+            if got is not None:
+                assert expected.returncode == 0, (command, expected.stdout)
+                got = got.replace(pseudo, real)
+                assert got == expected.stdout, (command, got, expected.stdout)
+                assert tree(real) == tree(pseudo), (command, tree(real), tree(pseudo))
+                # Time the read-only commands again, repeatedly.
+                if command.split()[0] not in PseudoShell.CHANGING:
+                    start = time.perf_counter()
+                    for _ in range(args.repeat):
+                        PseudoShell(env).run(command)
+                    python = (time.perf_counter() - start) / args.repeat
+            shutil.rmtree(real)
+            shutil.rmtree(pseudo)
+            print(
+                "%-32s %12.3f %12s"
+                % (command, sh * 1000, "(sh)" if got is None else "%.3f" % (python * 1000))
+            )
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
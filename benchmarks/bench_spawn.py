@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for starting the commands of examples, as the parent
+process grows: Starts /bin/true through `subprocess.Popen` (as
+`TestFileEnvironment.run` does by default), through `Popen` with a
+``preexec_fn`` (as it does with resource limits, which makes Python
+fork instead of vfork), and through `scripttest.posix_spawn`, and
+waits for it to exit.
+
+    python benchmarks/bench_spawn.py [--rss MB,MB,...] [--repeat N]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import scripttest  # noqa
+
+PAGE = 4096
+
+
+def grow(ballast, size):
+    """Append to `ballast` until it holds `size` bytes of touched memory."""
+    while sum(len(chunk) for chunk in ballast) < size:
+        chunk = bytearray(64 << 20)
+        chunk[::PAGE] = b"\1" * len(range(0, len(chunk), PAGE))
+        ballast.append(chunk)
+
+
+def rss():
+    """Return the resident set size of this process, in MB."""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * PAGE >> 20
+
+
+def launchers():
+    environ = os.environ.copy()
+    cwd = os.getcwd()
+    args = ["/bin/true"]
+
+    def popen(preexec_fn=None):
+        proc = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,
+            env=environ,
+            start_new_session=True,
+            preexec_fn=preexec_fn,
+        )
+        scripttest.communicate(proc)
+
+    limits = scripttest.limit_resources(cpu_limit=3600)
+    yield "popen", popen
+    yield "popen+limits", lambda: popen(limits)
+    if scripttest._load_spawn_libc() is not None:
+        envp = scripttest.environ_block(environ)
+        yield "posix_spawn", lambda: scripttest.communicate(
+            scripttest.posix_spawn(args, args[0], cwd, envp)
+        )
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument(
+        "--rss",
+        default="0,512,1024,2048",
+        help="comma separated sizes of the parent to measure at, in MB",
+    )
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args(args)
+
+    names = [name for name, _ in launchers()]
+    print("%-10s" % "RSS [MB]" + "".join("%20s" % (n + " [ms]") for n in names))
+    ballast = []
+    for size in (int(mb) << 20 for mb in args.rss.split(",")):
+        grow(ballast, size)
+        timings = []
+        for name, launch in launchers():
+            launch()  # warm up
+            seconds = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                launch()
+                seconds.append(time.perf_counter() - start)
+            timings.append(statistics.median(seconds) * 1000)
+        print("%-10d" % rss() + "".join("%20.3f" % t for t in timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the hot paths of scriptdoctest and scripttest: parsing,
+checking output, running commands with file snapshots, diffing them,
+and running whole documents. The results are written as JSON, so that
+runs on different commits can be compared.
+
+    python benchmarks/suite.py [--quick] [--only NAME] [--repeat N]
+                               [--output FILE] [--compare FILE]
+
+bench_parse.py and bench_normalize.py compare the parser and the
+output normalization to their former implementations, and
+bench_spawn.py the ways of starting commands as the parent grows;
+bench_pseudoshell.py checks the commands PSEUDOSHELL runs in Python
+against /bin/sh.
+"""
+
+import argparse
+import asyncio
+import doctest
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import scriptdoctest  # noqa
+import scripttest  # noqa
+import synthetic  # noqa
+
+BENCHMARKS = []
+
+
+def benchmark(**params):
+    """
+    Register a benchmark. It is called with `params` (scaled down by
+    `--quick`) and a temporary directory, and returns the function to
+    time.
+    """
+
+    def register(setup):
+        BENCHMARKS.append((setup.__name__, setup, params))
+        return setup
+
+    return register
+
+
+@benchmark(examples=2000)
+def parse_examples(tmp, examples):
+    text = synthetic.document(examples)
+    parser = scriptdoctest.ScriptDocTestParser()
+    return lambda: parser.parse(text)
+
+
+@benchmark(examples=10, want_lines=20000)
+def parse_huge_want(tmp, examples, want_lines):
+    text = synthetic.document(examples, want_lines=want_lines)
+    parser = scriptdoctest.ScriptDocTestParser()
+    return lambda: parser.parse(text)
+
+
+@benchmark(examples=200, want_lines=50, ellipses=10)
+def parse_ellipses(tmp, examples, want_lines, ellipses):
+    text = synthetic.document(examples, want_lines, ellipses, files=examples // 10)
+    parser = scriptdoctest.ScriptDocTestParser()
+    return lambda: parser.parse(text)
+
+
+@benchmark(lines=100000)
+def check_output_exact(tmp, lines):
+    got = synthetic.output(lines)
+    want = scriptdoctest.WantMatcher(got)
+    checker = scriptdoctest.EllipsisOutputChecker()
+    return lambda: checker.check_output(want, got, 0)
+
+
+@benchmark(lines=100000)
+def check_output_bytes(tmp, lines):
+    got = synthetic.output(lines).encode("ascii")
+    want = scriptdoctest.WantMatcher(got.decode("ascii"))
+    checker = scriptdoctest.EllipsisOutputChecker()
+    return lambda: checker.check_output(want, got, 0)
+
+
+@benchmark(lines=100000, ellipses=1000)
+def check_output_ellipsis(tmp, lines, ellipses):
+    got = synthetic.output(lines)
+    want = scriptdoctest.WantMatcher(synthetic.elided(got, ellipses))
+    checker = scriptdoctest.EllipsisOutputChecker()
+    return lambda: checker.check_output(want, got, doctest.ELLIPSIS)
+
+
+@benchmark(lines=100000)
+def check_output_whitespace(tmp, lines):
+    got = synthetic.output(lines)
+    want = scriptdoctest.WantMatcher(got.replace(" ", "  "))
+    checker = scriptdoctest.EllipsisOutputChecker()
+    return lambda: checker.check_output(want, got, doctest.NORMALIZE_WHITESPACE)
+
+
+@benchmark(lines=100000, ellipses=1000)
+def ellipsis_match(tmp, lines, ellipses):
+    got = synthetic.output(lines)
+    want = synthetic.elided(got, ellipses)
+    return lambda: scriptdoctest.EllipsisOutputChecker.ellipsis_match(want, got)
+
+
+def _environment(tmp, files, depth, **options):
+    env = scripttest.TestFileEnvironment(os.path.join(tmp, "workspace"), **options)
+    synthetic.workspace(env.base_path, files, depth)
+    return env
+
+
+@benchmark(files=5000, depth=5)
+def find_files(tmp, files, depth):
+    env = _environment(tmp, files, depth)
+    return env._find_files
+
+
+@benchmark(files=5000, depth=5)
+def run_snapshot(tmp, files, depth):
+    env = _environment(tmp, files, depth)
+    return lambda: env.run("/bin/sh", "-c", "echo x > new.txt; rm new.txt")
+
+
+@benchmark(files=5000, depth=5)
+def run_track_changes(tmp, files, depth):
+    env = _environment(tmp, files, depth, track_changes=True)
+    return lambda: env.run("/bin/sh", "-c", "echo x > new.txt; rm new.txt")
+
+
+@benchmark()
+def run_no_snapshot(tmp):
+    env = scripttest.TestFileEnvironment(os.path.join(tmp, "workspace"), snapshot=False)
+    return lambda: env.run("/bin/sh", "-c", "true")
+
+
+@benchmark()
+def run_posix_spawn(tmp):
+    env = scripttest.TestFileEnvironment(
+        os.path.join(tmp, "workspace"), snapshot=False, posix_spawn=True
+    )
+    return lambda: env.run("/bin/sh", "-c", "true")
+
+
+@benchmark(files=5000, depth=5, changed=100)
+def procresult_diff(tmp, files, depth, changed):
+    env = _environment(tmp, files, depth)
+    before = env._find_files()
+    for path in sorted(before)[:changed]:
+        if not before[path].invalid and os.path.isfile(before[path].full):
+            with open(before[path].full, "ab") as f:
+                f.write(b"changed")
+    after = env._find_files()
+    return lambda: scripttest.ProcResult(
+        env, ["true"], None, b"", "", 0, before, after
+    ).files_report()
+
+
+@benchmark(examples=100)
+def testfile(tmp, examples):
+    path = os.path.join(tmp, "echo.rst")
+    with open(path, "w") as f:
+        f.write(synthetic.echo_document(examples))
+    base = os.path.join(tmp, "workspace")
+
+    def run():
+        results = scriptdoctest.testfile(
+            path,
+            module_relative=False,
+            report=False,
+            verbose=False,
+            base_path=base,
+            out=lambda s: None,
+        )
+        assert not results.failed, results
+
+    return run
+
+
+@benchmark(examples=100)
+def testfile_session(tmp, examples):
+    path = os.path.join(tmp, "echo.rst")
+    with open(path, "w") as f:
+        f.write(synthetic.echo_document(examples))
+    base = os.path.join(tmp, "workspace")
+
+    def run():
+        results = scriptdoctest.testfile(
+            path,
+            module_relative=False,
+            report=False,
+            verbose=False,
+            base_path=base,
+            session=True,
+            out=lambda s: None,
+        )
+        assert not results.failed, results
+
+    return run
+
+
+@benchmark(examples=100)
+def testfile_direct(tmp, examples, optionflags=0):
+    path = os.path.join(tmp, "programs.rst")
+    with open(path, "w") as f:
+        f.write(synthetic.program_document(examples))
+    base = os.path.join(tmp, "workspace")
+
+    def run():
+        results = scriptdoctest.testfile(
+            path,
+            module_relative=False,
+            report=False,
+            verbose=False,
+            base_path=base,
+            optionflags=optionflags,
+            out=lambda s: None,
+        )
+        assert not results.failed, results
+
+    return run
+
+
+@benchmark(examples=100)
+def testfile_shell(tmp, examples):
+    return testfile_direct(tmp, examples, optionflags=scriptdoctest.SHELL)
+
+
+@benchmark(examples=100)
+def testfile_file_commands(tmp, examples, optionflags=scriptdoctest.PSEUDOSHELL):
+    path = os.path.join(tmp, "files.rst")
+    with open(path, "w") as f:
+        f.write(synthetic.file_command_document(examples))
+    base = os.path.join(tmp, "workspace")
+
+    def run():
+        results = scriptdoctest.testfile(
+            path,
+            module_relative=False,
+            report=False,
+            verbose=False,
+            base_path=base,
+            optionflags=optionflags,
+            out=lambda s: None,
+        )
+        assert not results.failed, results
+
+    return run
+
+
+@benchmark(examples=100)
+def testfile_file_commands_sh(tmp, examples):
+    return testfile_file_commands(tmp, examples, optionflags=0)
+
+
+@benchmark(documents=50, examples=10)
+def testfiles_async(tmp, documents, examples, concurrency=50):
+    directory = os.path.join(tmp, "documents")
+    os.makedirs(directory)
+    for i in range(documents):
+        with open(os.path.join(directory, "echo%d.rst" % i), "w") as f:
+            f.write(synthetic.echo_document(examples))
+    base = os.path.join(tmp, "workspace")
+
+    def run():
+        results = asyncio.run(
+            scriptdoctest.testfiles_async(
+                [directory],
+                concurrency=concurrency,
+                report=False,
+                verbose=False,
+                base_path=base,
+            )
+        )
+        assert not results.failed, results
+
+    return run
+
+
+@benchmark(documents=50, examples=10)
+def testfiles_async_serial(tmp, documents, examples):
+    return testfiles_async(tmp, documents, examples, concurrency=1)
+
+
+# Parameters that --quick leaves alone
+UNSCALED = ("depth",)
+
+
+def scaled(params, factor):
+    return {
+        name: value if name in UNSCALED else max(1, int(value * factor))
+        for name, value in params.items()
+    }
+
+
+def measure(setup, params, repeat):
+    """Set up a benchmark, and return its timings in seconds."""
+    tmp = tempfile.mkdtemp(prefix="scriptdoctest-bench-")
+    try:
+        function = setup(tmp, **params)
+        function()  # warm up, and fill caches
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+        return timings
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def commit():
+    """Return the git commit of the working tree, if there is one."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Print the ratios of the `results` to those of `baseline`."""
+    old = {b["name"]: b for b in baseline["benchmarks"]}
+    print("\n%-26s %12s %12s %8s" % ("benchmark", "old [ms]", "new [ms]", "ratio"))
+    for b in results["benchmarks"]:
+        if b["name"] not in old or old[b["name"]]["params"] != b["params"]:
+            continue
+        before, after = old[b["name"]]["min"], b["min"]
+        print(
+            "%-26s %12.3f %12.3f %8.2f"
+            % (b["name"], before * 1000, after * 1000, after / before)
+        )
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument(
+        "--quick", action="store_true", help="use inputs a tenth of the size"
+    )
+    parser.add_argument(
+        "--only", action="append", metavar="NAME", help="run only this benchmark"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", metavar="FILE", help="write the results here")
+    parser.add_argument(
+        "--compare", metavar="FILE", help="compare to the results in this file"
+    )
+    args = parser.parse_args(args)
+
+    results = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "benchmarks": [],
+    }
+    print("%-26s %12s %12s" % ("benchmark", "min [ms]", "median [ms]"))
+    for name, setup, params in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        if args.quick:
+            params = scaled(params, 0.1)
+        timings = measure(setup, params, args.repeat)
+        results["benchmarks"].append(
+            {
+                "name": name,
+                "params": params,
+                "min": min(timings),
+                "median": statistics.median(timings),
+                "timings": timings,
+            }
+        )
+        print(
+            "%-26s %12.3f %12.3f"
+            % (name, min(timings) * 1000, statistics.median(timings) * 1000)
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
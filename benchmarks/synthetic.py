@@ -0,0 +1,118 @@
+"""
+Generators of synthetic inputs for the benchmarks: documents, expected
+and actual outputs, and workspaces.
+"""
+
+import os
+import time
+
+
+def document(examples=1000, want_lines=3, ellipses=0, files=0):
+    """
+    Return a reStructuredText document with `examples` command examples
+    (in blocks of up to ten), each expecting `want_lines` lines of
+    output of which `ellipses` are elided, and `files` file
+    constructions.
+    """
+    parts = ["Synthetic document\n==================\n\n"]
+    for i in range(examples):
+        if i % 10 == 0:
+            parts.append("Block %d::\n\n" % (i // 10))
+        lines = ["line %d of output %d" % (j, i) for j in range(want_lines)]
+        for j in range(min(ellipses, len(lines))):
+            lines[j * len(lines) // ellipses] = "[...]"
+        if ellipses:
+            parts.append("    $ seq %d  # doctest: +ELLIPSIS\n" % want_lines)
+        else:
+            parts.append("    $ seq %d\n" % want_lines)
+        parts.extend("    %s\n" % line for line in lines)
+        if i % 10 == 9 or i == examples - 1:
+            parts.append("\nSome text between the blocks.\n\n")
+    for i in range(files):
+        parts.append(
+            "  ::\n\n"
+            "    content of file %d\n"
+            "    another line\n\n"
+            "  -- file%d.txt\n\n" % (i, i)
+        )
+    return "".join(parts)
+
+
+def echo_document(examples=100):
+    """
+    Return a document with `examples` quick examples that pass, for
+    running end to end.
+    """
+    parts = ["Echoes::\n\n"]
+    for i in range(examples):
+        parts.append("    $ echo %d\n    %d\n" % (i, i))
+    return "".join(parts)
+
+
+def program_document(examples=100):
+    """
+    Return a document with `examples` quick examples that pass, which
+    run a program rather than a shell builtin, for running end to end.
+    """
+    parts = ["Programs::\n\n"]
+    for i in range(examples):
+        parts.append("    $ seq %d %d\n    %d\n" % (i, i, i))
+    return "".join(parts)
+
+
+def file_command_document(examples=100):
+    """
+    Return a document with `examples` quick examples that pass, which
+    make, list, show and remove files, for running end to end.
+    """
+    parts = ["File commands::\n\n"]
+    for i in range(examples // 5):
+        parts.append(
+            "    $ mkdir -p d%d\n"
+            "    $ echo %d\n"
+            "    %d\n"
+            "    $ touch d%d/f\n"
+            "    $ ls d%d\n"
+            "    f\n"
+            "    $ rm -r d%d\n" % (i, i, i, i, i, i)
+        )
+    return "".join(parts)
+
+
+def output(lines=10000, width=60):
+    """Return `lines` lines of ASCII output, `width` characters each."""
+    line = "x" * (width - 10)
+    return "".join("%08d %s\n" % (i, line) for i in range(lines))
+
+
+def elided(text, ellipses=100):
+    """
+    Return `text` with `ellipses` of its lines, spread evenly, replaced
+    by "[...]", as expected output that `text` matches under ELLIPSIS.
+    """
+    lines = text.split("\n")
+    step = max(len(lines) // (ellipses + 1), 1)
+    for i in range(step, len(lines), step)[:ellipses]:
+        lines[i] = "[...]"
+    return "\n".join(lines)
+
+
+def workspace(path, files=5000, depth=5, size=64, age=3600):
+    """
+    Fill the directory `path` with `files` files of `size` bytes,
+    spread over a directory tree `depth` levels deep, ten directories
+    wide at each level. The files are dated `age` seconds back, so
+    that they are not racily clean (see `scripttest.FoundFile`).
+    """
+    mtime = time.time() - age
+    for i in range(files):
+        parts = []
+        n = i
+        for _ in range(depth):
+            parts.append("d%d" % (n % 10))
+            n //= 10
+        directory = os.path.join(path, *parts)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "f%d.txt" % i), "wb") as f:
+            f.write(b"x" * size)
+        os.utime(f.name, (mtime, mtime))
@@ -2,7 +2,19 @@ import os
 import sys
 import re
 import doctest
+import copy
+import json
+import time
+import shutil
+import fnmatch
+import hashlib
+import heapq
+import threading
+import asyncio
+import concurrent.futures
+import functools
 import tempfile
+import xml.sax.saxutils
 import unicodedata
 from doctest import (
     _load_testfile,
@@ -18,7 +30,6 @@ from doctest import (
     TestResults,
     REPORT_ONLY_FIRST_FAILURE,
     OPTIONFLAGS_BY_NAME,
-    master,
 )
 
 try:
@@ -43,6 +54,76 @@ import scripttest
 CREATE_FILE_BEFORE_TEST = register_optionflag("CREATE_FILE_BEFORE_TEST")
 PSEUDOSHELL = register_optionflag("PSEUDOSHELL")
 COVERAGE = register_optionflag("COVERAGE")
+SNAPSHOT = register_optionflag("SNAPSHOT")
+SHELL = register_optionflag("SHELL")
+
+# Sources with any of these need a shell: operators, expansions, globs,
+# escapes, line breaks, and "#" other than at the start of a word.
+_SHELL_SYNTAX_RE = re.compile(r"[|&;<>()$`\\*?\[\]{}~\n]|\S#")
+
+# Commands that the shell runs itself, or which it treats specially.
+SHELL_BUILTINS = frozenset(
+    """
+    ! . : [ alias bg break case cd command continue do done echo elif else
+    esac eval exec exit export false fc fg fi for getopts hash if jobs kill
+    local printf pwd read readonly return set shift source test then times
+    trap true type ulimit umask unalias unset until wait while { }
+    """.split()
+)
+
+# Settings are option directives that carry a value. They are written
+# as `NAME=value` next to the usual flags, eg. `#doctest: SNAPSHOT=build`.
+SETTINGS_BY_NAME = {}
+
+
+def register_setting(name, convert=str):
+    """Register a setting directive `name`, whose value is converted
+    using `convert`. Return the name, which is the key of the setting
+    in `ScriptExample.settings`."""
+    SETTINGS_BY_NAME.setdefault(name, convert)
+    return name
+
+
+# Only look at changes to files in the given directory (relative to
+# the base path) while running the example.
+register_setting("SNAPSHOT")
+
+# Kill the example after the given number of seconds.
+register_setting("TIMEOUT", float)
+
+# Fail (or warn) if the example takes longer than the given number of
+# seconds.
+register_setting("BUDGET", float)
+
+
+######################################################################
+# 2. ScriptExample
+######################################################################
+
+
+class ScriptExample(Example):
+    """
+    A single scriptdoctest example. In addition to the attributes of
+    `doctest.Example`, it has
+
+      - settings: A dictionary mapping the names of setting directives
+        (see `register_setting`) to their values for this example.
+
+      - section: The number of the section of the document the example
+        is in. Each section runs in a workspace of its own.
+
+      - matcher: The `WantMatcher` that `EllipsisOutputChecker` checks
+        the actual output against, compiled once from `want`.
+    """
+
+    def __init__(self, source, want, exc_msg=None, lineno=0, indent=0,
+                 options=None, settings=None, section=0):
+        Example.__init__(self, source, want, exc_msg, lineno, indent, options)
+        if settings is None:
+            settings = {}
+        self.settings = settings
+        self.section = section
+        self.matcher = WantMatcher(self.want)
 
 
 ######################################################################
@@ -53,13 +134,32 @@ COVERAGE = register_optionflag("COVERAGE")
 class ScriptDocTestParser(doctest.DocTestParser):
     """
     A class used to parse strings containing scriptdoctest examples.
+
+    A line consisting of the reStructuredText comment
+
+        .. scriptdoctest: section
+
+    starts a new section: The examples after it do not depend on those
+    before it, and are run in a fresh workspace.
     """
 
-    # This regular expression is used to find doctest examples in a
+    # This regular expression finds the comments that start a new section.
+    _SECTION_RE = re.compile(
+        r"^[ ]*\.\.[ ]+scriptdoctest:[ ]*section[ ]*$", re.MULTILINE
+    )
+
+    # This regular expression specifies the doctest examples in a
     # string.  It defines three groups: `source` is the source code
     # (including leading indentation and prompts); `indent` is the
     # indentation of the first (PS1) line of the source code; and
     # `want` is the expected output (including leading indentation).
+    #
+    # The options and the content of a file construction are each
+    # matched as far as they go, and never given back: a lookahead
+    # captures them, and a backreference then consumes the capture
+    # (`(?=(?P<x>...))(?P=x)`, an atomic group).  Otherwise, a file
+    # construction without a file name makes the matching backtrack
+    # exponentially in the number of its lines.
     _EXAMPLE_RE = re.compile(
         r"""(
         # Source consists of ::, an empty line, and then a PS1 line
@@ -75,11 +175,11 @@ class ScriptDocTestParser(doctest.DocTestParser):
         )|(
         # Alternatively, we also need to consider file content examples.
         ^(?P<preindent> [ ]*) ::\n
-        (?P<options>(
+        (?=(?P<options>(
             ([ ]*\n)|
-            (?P=preindent)[#] .*\n)*)
-        (?P<content>
-            ((?P<fullindent> (?P=preindent)[ ]+).*\n)*)
+            (?P=preindent)[#] .*\n)*))(?P=options)
+        (?=(?P<content>
+            ((?P<fullindent> (?P=preindent)[ ]+).*\n)*))(?P=content)
         \n?
         (?P=preindent) ---? [ ]* (?P<filename> .*)$
         )""",
@@ -111,6 +211,57 @@ class ScriptDocTestParser(doctest.DocTestParser):
         re.VERBOSE | re.MULTILINE | re.DOTALL,
     )
 
+    def _find_options(self, source, name, lineno):
+        """
+        Return a dictionary containing option overrides extracted from
+        option directives in the given source string. Settings
+        (`NAME=value`) are ignored; use `_find_settings` for those.
+        """
+        return self._find_directives(source, name, lineno)[0]
+
+    def _find_settings(self, source, name, lineno):
+        """
+        Return a dictionary containing the settings (`NAME=value`)
+        extracted from option directives in the given source string.
+        """
+        return self._find_directives(source, name, lineno)[1]
+
+    def _find_directives(self, source, name, lineno):
+        """
+        Return a pair `(options, settings)` of the option flags and the
+        settings given in option directives in the given source string.
+
+        `name` is the string's name, and `lineno` is the line number
+        where the example starts; both are used for error messages.
+        """
+        options = {}
+        settings = {}
+        for m in self._OPTION_DIRECTIVE_RE.finditer(source):
+            option_strings = m.group(1).replace(",", " ").split()
+            for option in option_strings:
+                setting, eq, value = option.partition("=")
+                if eq and setting in SETTINGS_BY_NAME:
+                    try:
+                        settings[setting] = SETTINGS_BY_NAME[setting](value)
+                    except ValueError:
+                        raise ValueError(
+                            "line %r of the doctest for %s "
+                            "has an invalid setting: %r" % (lineno + 1, name, option)
+                        )
+                elif option[0] in "+-" and option[1:] in OPTIONFLAGS_BY_NAME:
+                    options[OPTIONFLAGS_BY_NAME[option[1:]]] = option[0] == "+"
+                else:
+                    raise ValueError(
+                        "line %r of the doctest for %s "
+                        "has an invalid option: %r" % (lineno + 1, name, option)
+                    )
+        if (options or settings) and self._IS_BLANK_OR_COMMENT(source):
+            raise ValueError(
+                "line %r of the doctest for %s has an option "
+                "directive on a line with no example: %r" % (lineno, name, source)
+            )
+        return options, settings
+
     def get_doctest(self, string, globs, name, filename, lineno):
         """
         Extract all doctest examples from the given string, and
@@ -124,9 +275,16 @@ class ScriptDocTestParser(doctest.DocTestParser):
             self.get_examples(string, name), globs, name, filename, lineno, string
         )
 
+    def _find_examples(self, string):
+        """
+        Return an iterator over the matches of `_EXAMPLE_RE` in
+        `string`.
+        """
+        return self._EXAMPLE_RE.finditer(string)
+
     def _parse_example(self, m, name, lineno):
         """
-        Given a regular expression match from `_EXAMPLE_RE` (`m`),
+        Given a match of `_EXAMPLE_RE` (`m`),
         return a pair `(source, want)`, where `source` is the matched
         example's source code (with prompts and indentation stripped);
         and `want` is the example's expected output (with indentation
@@ -160,14 +318,17 @@ class ScriptDocTestParser(doctest.DocTestParser):
                         pass
                     else:
                         # Extract options from the source.
-                        options = self._find_options(source, name, lineno)
-                        yield Example(
+                        options, settings = self._find_directives(
+                            source, name, lineno
+                        )
+                        yield ScriptExample(
                             source,
                             "\n".join(want),
                             "",
                             lineno=lineno + example_lineno,
                             indent=indent,
                             options=options,
+                            settings=settings,
                         )
                     source = line[2:]
                     want = []
@@ -182,14 +343,15 @@ class ScriptDocTestParser(doctest.DocTestParser):
 
             # Construct the last example.
             # Extract options from the source.
-            options = self._find_options(source, name, lineno)
-            yield Example(
+            options, settings = self._find_directives(source, name, lineno)
+            yield ScriptExample(
                 source,
                 "\n".join(want),
                 "",
                 lineno=lineno + example_lineno,
                 indent=indent,
                 options=options,
+                settings=settings,
             )
         # File constructions, on the other hand, don't match that
         # branch of the regular expression. Instead, they are have two
@@ -207,16 +369,19 @@ class ScriptDocTestParser(doctest.DocTestParser):
             # The file name is just that, stripped.
             filename = m.group("filename")
 
-            options = self._find_options(m.group("options"), name, lineno)
+            options, settings = self._find_directives(
+                m.group("options"), name, lineno
+            )
             options[CREATE_FILE_BEFORE_TEST] = True
 
-            yield Example(
+            yield ScriptExample(
                 "cat {:s}".format(sh_quote(filename)),
                 file_content,
                 None,
                 lineno=lineno,
                 indent=indent,
                 options=options,
+                settings=settings,
             )
 
     def parse(self, string, name="<string>"):
@@ -234,19 +399,21 @@ class ScriptDocTestParser(doctest.DocTestParser):
             string = "\n".join([l[min_indent:] for l in string.split("\n")])
 
         output = []
-        charno, lineno = 0, 0
+        charno, lineno, section = 0, 0, 0
         # Find all doctest examples in the string:
-        for m in self._EXAMPLE_RE.finditer(string):
+        for m in self._find_examples(string):
             # Add the pre-example text to `output`.
             output.append(string[charno : m.start()])
             # Update lineno (lines before this example)
             lineno += string.count("\n", charno, m.start())
+            # Update section (section markers before this example)
+            section += len(self._SECTION_RE.findall(string, charno, m.start()))
             # Extract info from the regexp match and create an Example
             for example in self._parse_example(m, name, lineno):
+                example.section = section
                 output.append(example)
             # Update lineno (lines inside this example)
             lineno += string.count("\n", m.start(), m.end())
-            print(lineno)
             # Update charno.
             charno = m.end()
         # Add any remaining post-example text to `output`.
@@ -270,6 +437,7 @@ class ScriptDocTestParser(doctest.DocTestParser):
 ######################################################################
 
 ansi_escape = re.compile(r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
+ansi_escape_bytes = re.compile(ansi_escape.pattern.encode("ascii"))
 
 
 class EllipsisOutputChecker(doctest.OutputChecker):
@@ -343,8 +511,15 @@ class EllipsisOutputChecker(doctest.OutputChecker):
         if "[..." not in want:
             return want == got
 
+        return EllipsisOutputChecker.match_pieces(
+            EllipsisOutputChecker.ellipsis_pieces(want), got
+        )
+
+    @staticmethod
+    def ellipsis_pieces(want):
+        """Split `want`, which contains at least one ellipsis, into the
+        strings that have to match exactly, for `match_pieces`."""
         want = want + "\n"
-        got = got + "\n"
 
         # Find "the real" strings.
         raw_ws = want.split("[...")
@@ -358,6 +533,15 @@ class EllipsisOutputChecker(doctest.OutputChecker):
                 ws.append(w[i + 2 :])
             else:
                 ws.append(w[i + 1 :])
+        return ws
+
+    @staticmethod
+    def match_pieces(ws, got):
+        """Return True iff `got` matches the pieces `ws` of an expected
+        output (see `ellipsis_pieces`) with anything between them.
+        `got` and the pieces may also all be bytes."""
+        got = got + (b"\n" if isinstance(got, bytes) else "\n")
+        ws = list(ws)
 
         # Deal with exact matches possibly needed at one or both ends.
         startpos, endpos = 0, len(got)
@@ -395,6 +579,43 @@ class EllipsisOutputChecker(doctest.OutputChecker):
 
         return True
 
+    def output_watcher(self, want, optionflags):
+        """
+        Return an `OutputWatcher` that tells, while the output of an
+        example comes in, when it can no longer match `want` under
+        `optionflags`; or None if that cannot be told early.
+        """
+        if optionflags & doctest.NORMALIZE_WHITESPACE:
+            return None
+        if not isinstance(want, WantMatcher):
+            want = WantMatcher(want)
+        if optionflags & doctest.ELLIPSIS and want.has_ellipsis:
+            return OutputWatcher(want.pieces()[0], exact=False)
+        return OutputWatcher(want.want, exact=True)
+
+    @staticmethod
+    def normalize(text):
+        """
+        Normalize `text` as expected output: Remove ANSI escape
+        sequences, normalize unicode to NFC and expand tabs. Each step
+        is skipped when there is nothing for it to do.
+
+        `text` may also be ASCII bytes, which are normalized as bytes.
+        """
+        if isinstance(text, bytes):
+            if b"\x1b" in text:
+                text = ansi_escape_bytes.sub(b"", text)
+            if b"\t" in text:
+                text = text.replace(b"\t", b"    ")
+            return text
+        if "\x1b" in text:
+            text = ansi_escape.sub("", text)
+        if not text.isascii():
+            text = unicodedata.normalize("NFC", text)
+        if "\t" in text:
+            text = text.replace("\t", "    ")
+        return text
+
     def check_output(self, want, got, optionflags):
         """
         Return True iff the actual output from an example (`got`)
@@ -404,9 +625,17 @@ class EllipsisOutputChecker(doctest.OutputChecker):
         several non-exact match types are also possible.  See the
         documentation for `TestRunner` for more information about
         option flags.
-        """
 
-        print(optionflags)
+        `want` may also be a `WantMatcher`, which saves normalizing
+        and splitting it again on each check. `got` may also be the
+        UTF-8 encoded output; if both are ASCII, it is then checked
+        without decoding it.
+        """
+        if not isinstance(want, WantMatcher):
+            want = WantMatcher(want)
+        if isinstance(got, bytes) and not (want.is_ascii and got.isascii()):
+            got = got.decode("utf-8")
+        encoded = isinstance(got, bytes)
 
         # If `want` contains no ANSI C1 escape sequences, but `got` is
         # generated with them eg. from a program that uses color output, they
@@ -415,27 +644,31 @@ class EllipsisOutputChecker(doctest.OutputChecker):
 
         # In addition, we normalize the unicode form, and if there are carriage
         # returns on a line, we assume they indeed reset the line.
-        got = ansi_escape.sub("", got)
-        got = unicodedata.normalize("NFC", got)
-        got = got.replace("\t", "    ")
-        got = "\n".join(line.rsplit("\r", 1)[-1] for line in got.split("\n"))
-
-        want = ansi_escape.sub("", want)
-        want = unicodedata.normalize("NFC", want)
-        want = want.replace("\t", "    ")
+        got = self.normalize(got)
+        if encoded:
+            if b"\r" in got:
+                got = b"\n".join(
+                    line.rsplit(b"\r", 1)[-1] for line in got.split(b"\n")
+                )
+        elif "\r" in got:
+            got = "\n".join(line.rsplit("\r", 1)[-1] for line in got.split("\n"))
 
         # Handle the common case first, for efficiency:
         # if they're string-identical, always return true.
-        if got == want:
+        if got == (want.encoded if encoded else want.want):
             return True
 
         # This flag causes doctest to ignore any differences in the
         # contents of whitespace strings.  Note that this can be used
         # in conjunction with the ELLIPSIS flag.
-        if optionflags & doctest.NORMALIZE_WHITESPACE:
+        collapse = bool(optionflags & doctest.NORMALIZE_WHITESPACE)
+        if collapse:
+            if encoded:
+                # bytes.split() knows fewer whitespace characters.
+                got = got.decode("ascii")
+                encoded = False
             got = " ".join(got.split())
-            want = " ".join(want.split())
-            if got == want:
+            if got == want.collapsed:
                 return True
 
         # The ELLIPSIS flag says to let the regex "\[\.\.\.[^]]*\]",
@@ -443,18 +676,410 @@ class EllipsisOutputChecker(doctest.OutputChecker):
         # match any substring in `got`. If such an ellipsis expression
         # is on a separate line, it can match any number (including 0)
         # of lines.
-        if optionflags & doctest.ELLIPSIS:
-            if self.ellipsis_match(want, got):
+        if optionflags & doctest.ELLIPSIS and want.has_ellipsis:
+            if self.match_pieces(want.pieces(collapse, encoded), got):
                 return True
 
         return False
 
 
+class WantMatcher(object):
+    """
+    The expected output of an example, prepared for
+    `EllipsisOutputChecker.check_output`: It is normalized once, and
+    split into the pieces between ellipses at most once for each of
+    its two forms, as it is (`want`) and with whitespace collapsed
+    (`collapsed`, for NORMALIZE_WHITESPACE).
+    """
+
+    def __init__(self, want):
+        self.want = EllipsisOutputChecker.normalize(want)
+        self.has_ellipsis = "[..." in self.want
+        # ASCII expected output can be compared to undecoded output.
+        self.is_ascii = self.want.isascii()
+        self.encoded = self.want.encode("ascii") if self.is_ascii else None
+        self._collapsed = None
+        self._pieces = {}
+
+    @property
+    def collapsed(self):
+        if self._collapsed is None:
+            self._collapsed = " ".join(self.want.split())
+        return self._collapsed
+
+    def pieces(self, collapsed=False, encoded=False):
+        """The result of `EllipsisOutputChecker.ellipsis_pieces` for
+        the (`collapsed`) expected output, as ASCII bytes if
+        `encoded`."""
+        key = collapsed, encoded
+        if key not in self._pieces:
+            pieces = EllipsisOutputChecker.ellipsis_pieces(
+                self.collapsed if collapsed else self.want
+            )
+            if encoded:
+                pieces = [piece.encode("ascii") for piece in pieces]
+            self._pieces[key] = pieces
+        return self._pieces[key]
+
+
+class OutputWatcher(object):
+    """
+    Checks the output of an example while it comes in, line by line.
+    Calling it with the next chunk of output (as bytes) returns False
+    once the output cannot match any more, ie. once its complete lines
+    (normalized like `EllipsisOutputChecker.check_output` does) are no
+    longer a prefix of `want` (if `exact`), or no longer agree with the
+    beginning `want` of the expected output up to the first ellipsis.
+    """
+
+    def __init__(self, want, exact=True):
+        self.want = want
+        self.exact = exact
+        # How much of `want` the complete lines so far have matched
+        self.pos = 0
+        self.pending = b""
+        self.matches = True
+
+    def __call__(self, chunk):
+        if not self.matches:
+            return False
+        if not self.exact and self.pos >= len(self.want):
+            # The rest is up to the ellipses.
+            return True
+        lines = (self.pending + chunk).split(b"\n")
+        self.pending = lines.pop()
+        for line in lines:
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            line = line.decode("utf-8", "replace").rsplit("\r", 1)[-1]
+            line = EllipsisOutputChecker.normalize(line) + "\n"
+            if self.exact or len(line) < len(self.want) - self.pos:
+                self.matches = self.want.startswith(line, self.pos)
+            else:
+                self.matches = line.startswith(self.want[self.pos :])
+            self.pos += len(line)
+            if not self.matches:
+                return False
+            if not self.exact and self.pos >= len(self.want):
+                return True
+        return True
+
+
 ######################################################################
 # 5. ScriptDocTest Runner
 ######################################################################
 
 
+def simple_argv(source):
+    """
+    Return the words of the command `source`, or None if it uses any
+    shell syntax besides words, quotes and a trailing comment.
+    """
+    source = source.rstrip("\n")
+    if _SHELL_SYNTAX_RE.search(source):
+        return None
+    try:
+        return sh_split(source, comments=True) or None
+    except ValueError:
+        return None
+
+
+def _run_steps(steps):
+    """
+    Run the generator `steps`, and return what it returns.  It yields
+    the calls that may block, as tuples `(obj, method, args, kwargs)`,
+    and is sent the result of each call, or thrown its exception.
+    """
+    result = error = None
+    while True:
+        try:
+            if error is None:
+                obj, method, args, kwargs = steps.send(result)
+            else:
+                obj, method, args, kwargs = steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            error = None
+        try:
+            result = getattr(obj, method)(*args, **kwargs)
+        except BaseException as e:
+            result, error = None, e
+
+
+async def _run_steps_async(steps):
+    """
+    Like `_run_steps`, but call the coroutine method `method + "_async"`
+    of each `obj` instead, so that the event loop runs other tasks
+    while it waits.
+    """
+    result = error = None
+    while True:
+        try:
+            if error is None:
+                obj, method, args, kwargs = steps.send(result)
+            else:
+                obj, method, args, kwargs = steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            error = None
+        try:
+            result = await getattr(obj, method + "_async")(*args, **kwargs)
+        except BaseException as e:
+            result, error = None, e
+
+
+class _Blocking(object):
+    """
+    The `obj` of steps that call a function which blocks on files, eg.
+    `(_BLOCKING, "call", [shutil.rmtree, path], {})`: `_run_steps`
+    calls it, and `_run_steps_async` in a thread of the event loop's
+    default executor.
+    """
+
+    @staticmethod
+    def call(function, *args, **kwargs):
+        return function(*args, **kwargs)
+
+    @staticmethod
+    async def call_async(function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(function, *args, **kwargs)
+        )
+
+
+_BLOCKING = _Blocking()
+
+
+class PseudoShell(object):
+    """
+    The commands that `PSEUDOSHELL` runs in Python, in the working
+    directory and environment of a `scripttest.TestFileEnvironment`:
+    ``echo``, ``pwd``, ``ls`` (with ``-a``, ``-A``, ``-1``), ``cat``,
+    ``mkdir`` (with ``-p``), ``touch`` and ``rm`` (with ``-f``,
+    ``-r``).
+
+    Each command returns its output, as bytes, or None if the real
+    command has to run instead: For other flags, for anything that
+    would fail (so that the error messages are those of the system),
+    and for listings that would not be sorted bytewise, since the
+    order of ``ls`` depends on the locale.
+    """
+
+    # Commands that change files, which are left to the real commands
+    # when changes are to be reported.
+    CHANGING = frozenset(["mkdir", "touch", "rm"])
+
+    def __init__(self, env):
+        self.env = env
+
+    def run(self, source, change=True):
+        """
+        Return the output of the command `source`, as a string, or
+        None if the real command has to run.  Commands that change
+        files are only run if `change` is true.
+        """
+        argv = simple_argv(source)
+        if argv is None or argv[0] not in ("echo", "pwd", "ls", "cat") + tuple(
+            self.CHANGING
+        ):
+            return None
+        if argv[0] in self.CHANGING:
+            if not change:
+                return None
+            # Through a symbolic link, "a/.." need not be the directory
+            # that contains "a", where the real command would act.
+            if any(os.pardir in arg.split(os.sep) for arg in argv[1:]):
+                return None
+        try:
+            output = getattr(self, argv[0])(argv[1:])
+        except OSError:
+            # The real command will report it; changing commands were
+            # checked beforehand, so they are not half done.
+            return None
+        if output is None:
+            return None
+        try:
+            return output.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+
+    def _path(self, name):
+        return os.path.join(self.env.cwd, name)
+
+    @staticmethod
+    def _removable(path):
+        """
+        Return whether `path`, and all that is below it, can be
+        removed, so that ``rm`` does not stop half done.
+        """
+
+        def error(e):
+            raise e
+
+        if not os.access(os.path.dirname(os.path.normpath(path)), os.W_OK | os.X_OK):
+            return False
+        if os.path.islink(path) or not os.path.isdir(path):
+            return True
+        for dirpath, dirnames, filenames in os.walk(path, onerror=error):
+            if not os.access(dirpath, os.R_OK | os.W_OK | os.X_OK):
+                return False
+        return True
+
+    @staticmethod
+    def _options(args, allowed):
+        """
+        Return the set of the single letter flags in `args` and the
+        other arguments, or None if there is another flag.
+        """
+        flags = set()
+        operands = []
+        for arg in args:
+            if arg.startswith("-") and arg != "-":
+                if arg == "--" or not set(arg[1:]) <= set(allowed):
+                    return None
+                flags.update(arg[1:])
+            else:
+                operands.append(arg)
+        return flags, operands
+
+    def _bytewise(self):
+        """Return whether the locale sorts file names bytewise."""
+        for name in ("LC_ALL", "LC_COLLATE", "LANG"):
+            value = self.env.environ.get(name)
+            if value:
+                return value.split(".")[0] in ("C", "POSIX")
+        return True
+
+    def echo(self, args):
+        newline = b"\n"
+        if args and args[0] == "-n":
+            args, newline = args[1:], b""
+        if args and re.match("-[neE]+$", args[0]):
+            # Shells differ in these.
+            return None
+        return os.fsencode(" ".join(args)) + newline
+
+    def pwd(self, args):
+        if args:
+            return None
+        return os.fsencode(os.path.realpath(self.env.cwd)) + b"\n"
+
+    def ls(self, args):
+        options = self._options(args, "aA1")
+        if options is None or not self._bytewise():
+            return None
+        flags, operands = options
+        if "a" in flags and "A" in flags:
+            return None
+
+        def listing(path):
+            names = os.listdir(path)
+            if "a" in flags:
+                names += [".", ".."]
+            elif "A" not in flags:
+                names = [name for name in names if not name.startswith(".")]
+            return b"".join(os.fsencode(name) + b"\n" for name in sorted(names, key=os.fsencode))
+
+        if not operands:
+            return listing(self.env.cwd)
+        files = []
+        directories = []
+        for operand in operands:
+            path = self._path(operand)
+            if not os.path.lexists(path):
+                return None
+            (directories if os.path.isdir(path) else files).append(operand)
+        output = [os.fsencode(f) + b"\n" for f in sorted(files, key=os.fsencode)]
+        for directory in sorted(directories, key=os.fsencode):
+            if len(operands) > 1:
+                if output:
+                    output.append(b"\n")
+                output.append(os.fsencode(directory) + b":\n")
+            output.append(listing(self._path(directory)))
+        return b"".join(output)
+
+    def cat(self, args):
+        options = self._options(args, "")
+        if options is None or not options[1]:
+            return None
+        paths = [self._path(operand) for operand in options[1]]
+        if not all(os.path.isfile(path) for path in paths):
+            return None
+        output = []
+        for path in paths:
+            with open(path, "rb") as f:
+                output.append(f.read())
+        return b"".join(output)
+
+    def mkdir(self, args):
+        options = self._options(args, "p")
+        if options is None or not options[1]:
+            return None
+        flags, operands = options
+        paths = [os.path.normpath(self._path(operand)) for operand in operands]
+        for path in paths:
+            if "p" in flags:
+                if os.path.lexists(path) and not os.path.isdir(path):
+                    return None
+            elif os.path.lexists(path) or not os.path.isdir(os.path.dirname(path)):
+                return None
+        if "p" not in flags and len(set(paths)) < len(paths):
+            return None
+        for path in paths:
+            if "p" in flags:
+                os.makedirs(path, exist_ok=True)
+            else:
+                os.mkdir(path)
+        return b""
+
+    def touch(self, args):
+        options = self._options(args, "")
+        if options is None or not options[1]:
+            return None
+        paths = [self._path(operand) for operand in options[1]]
+        for path in paths:
+            if not os.path.exists(path) and not os.path.isdir(
+                os.path.dirname(os.path.normpath(path))
+            ):
+                return None
+        for path in paths:
+            if os.path.exists(path):
+                os.utime(path, None)
+            else:
+                open(path, "ab").close()
+        return b""
+
+    def rm(self, args):
+        options = self._options(args, "frR")
+        if options is None or not options[1]:
+            return None
+        flags, operands = options
+        recursive = "r" in flags or "R" in flags
+        paths = []
+        for operand in operands:
+            if os.path.basename(os.path.normpath(operand)) in (".", "..", os.sep, ""):
+                return None
+            path = self._path(operand)
+            if not os.path.lexists(path):
+                if "f" not in flags:
+                    return None
+                continue
+            if os.path.isdir(path) and not os.path.islink(path) and not recursive:
+                return None
+            if not self._removable(path):
+                return None
+            paths.append(path)
+        for path in paths:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+        return b""
+
+
 class ScriptDocTestRunner(doctest.DocTestRunner):
     """A class used to run DocTest test cases for scripts, and accumulate
     statistics.  The `run` method is used to process a single DocTest
@@ -494,6 +1119,9 @@ class ScriptDocTestRunner(doctest.DocTestRunner):
         >>> runner.failures
         0
 
+    `run_async` is a coroutine version of `run`, so that many DocTest
+    cases can run on one event loop, each with a runner of its own.
+
     The comparison between expected outputs and actual outputs is done
     by an `OutputChecker`.  This comparison may be customized with a
     number of option flags; see the documentation for `testmod` for
@@ -501,6 +1129,13 @@ class ScriptDocTestRunner(doctest.DocTestRunner):
     comparison may also be customized by passing a subclass of
     `OutputChecker` to the constructor.
 
+    Each example is run by ``/bin/sh -c``, unless it is a simple
+    command that needs no shell (see `_direct_argv`); that is started
+    directly, which saves starting the shell.  The `SHELL` option flag
+    forces the shell.  A command run directly that is killed by a
+    signal gets its exit status as the shell reports it, but not the
+    shell's message (eg. "Killed").
+
     The test runner's display output can be controlled in two ways.
     First, an output function (`out) can be passed to
     `TestRunner.run`; this function will be called with strings that
@@ -516,7 +1151,31 @@ class ScriptDocTestRunner(doctest.DocTestRunner):
     # separate sections of the summary.
     DIVIDER = "*" * 70
 
-    def __init__(self, checker=None, verbose=None, optionflags=0, base_path=None):
+    def __init__(
+        self,
+        checker=None,
+        verbose=None,
+        optionflags=0,
+        base_path=None,
+        snapshot=False,
+        track_changes=False,
+        session=False,
+        section_jobs=1,
+        checkpoints=None,
+        early_abort=False,
+        timeout=None,
+        memory_limit=None,
+        cpu_limit=None,
+        listeners=None,
+        budget=None,
+        document_budget=None,
+        over_budget="fail",
+        template=None,
+        tmpfs=None,
+        tmpfs_size=None,
+        pool=None,
+        posix_spawn=False,
+    ):
         """
         Create a new test runner.
 
@@ -532,6 +1191,82 @@ class ScriptDocTestRunner(doctest.DocTestRunner):
         test runner compares expected output to actual output, and how
         it displays failures.  See the documentation for `testmod` for
         more information.
+
+        Optional argument `snapshot` says which files to check for
+        changes around each example, see `TestFileEnvironment`. By
+        default, nothing is checked. Examples can override this using
+        the `+SNAPSHOT` flag (the whole base path) or the `SNAPSHOT=path`
+        setting (only that subtree of the working directory); the file changes
+        are then reported in verbose mode and for failures.
+
+        If `track_changes` is true, full snapshots are kept up to date
+        using inotify instead of walking the workspace; see
+        `TestFileEnvironment`.
+
+        If `session` is true, all examples of a DocTest are run by the
+        same shell process (see `ShellSession`), so `cd`, `export` and
+        shell functions persist between examples without the
+        `PSEUDOSHELL` emulation, and running short commands is much
+        faster.
+
+        Optional argument `section_jobs` gives the number of sections
+        of a document that may be run at the same time, each in its own
+        workspace.
+
+        Optional argument `checkpoints` is a `CheckpointStore`. The
+        workspace is then saved after each passing example, and a
+        section resumes after the last example that did not change
+        since a previous run. This does not work with `session`.
+
+        If `early_abort` is true, the output of each example is checked
+        while it comes in, and the example is killed and failed as soon
+        as its output cannot match any more (see `OutputWatcher`).
+
+        Optional argument `timeout` gives the number of seconds after
+        which an example is killed and fails; examples can override it
+        using the `TIMEOUT=seconds` setting. `memory_limit` (in bytes)
+        and `cpu_limit` (in seconds) limit each process the examples
+        start, see `TestFileEnvironment`.
+
+        Optional argument `listeners` is a list of `Listener` objects.
+        Their `example_timings(test, example, timings)` method is called
+        after each example, with a dictionary of the seconds spent in
+        each of its phases: `prepare`, the phases of `ProcResult.timings`,
+        `run` (the rest of running the command), `check`, `report` and
+        `checkpoint`. See `PhaseBreakdown`. Then their
+        `example_finished(test, example, record)` method is called with
+        a dictionary describing the outcome, see `Listener`.
+
+        Optional argument `budget` gives the number of seconds an
+        example may take; examples can override it using the
+        `BUDGET=seconds` setting. `document_budget` gives the number of
+        seconds all examples of a document may take together. Unlike a
+        timeout, a budget does not stop the example; if `over_budget`
+        is "fail" (the default), an example or document that took
+        longer fails, if it is "warn", a warning is written instead.
+
+        Optional argument `template` is a directory whose files every
+        workspace starts with, see `TestFileEnvironment.seed`.  The
+        files are reflinked where the filesystem supports it, and
+        files that nobody may write are hard linked.
+
+        Optional argument `tmpfs` is a directory in RAM, such as
+        ``/dev/shm``, to create the workspaces in when no `base_path`
+        is given, as long as it has `tmpfs_size` bytes free.  A
+        workspace that grows beyond `tmpfs_size` is moved to disk after
+        the example (except in a `session`), see
+        `TestFileEnvironment.spill`.  Workspaces in RAM are removed
+        when their examples are done.
+
+        Optional argument `pool` is a `scripttest.WorkspacePool`.  It
+        provides the workspaces when no `base_path` is given, and
+        deletes them in the background when their examples are done.
+        Workspaces at `base_path` are cleared in the background too.
+
+        If `posix_spawn` is true, the examples are started with the
+        `posix_spawn` of the C library where possible, which does not
+        slow down as the Python process grows; see
+        `TestFileEnvironment`.
         """
         self._checker = checker or EllipsisOutputChecker()
         if verbose is None:
@@ -553,8 +1288,90 @@ class ScriptDocTestRunner(doctest.DocTestRunner):
         else:
             self.directory = None
 
+        self.snapshot = snapshot
+        self.track_changes = track_changes
+        self.session = session
+        self.section_jobs = section_jobs
+        self.checkpoints = checkpoints
+        self.early_abort = early_abort
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit
+        self.budget = budget
+        self.document_budget = document_budget
+        self.over_budget = over_budget
+        self.template = template
+        self.tmpfs = tmpfs
+        self.tmpfs_size = tmpfs_size
+        self.pool = pool
+        self.posix_spawn = posix_spawn
+        self.listeners = list(listeners or ())
+
     # Reporting methods
 
+    def report_files(self, out, test, example, result):
+        """
+        Report the files changed by the given example, as recorded in
+        the `ProcResult` `result`.
+        """
+        files = result.files_report()
+        if files:
+            out("\n".join(files) + "\n")
+
+    def report_resume(self, out, test, example):
+        """
+        Report that the examples up to `example` were not run, but
+        their outcome restored from a checkpoint.
+        """
+        out(
+            "Resuming from the checkpoint after line %s\n"
+            % (test.lineno + example.lineno + 1)
+        )
+
+    def report_aborted(self, out, test, example):
+        """
+        Report that the given example was stopped early, because its
+        output could no longer match.
+        """
+        out("Stopped as soon as the output could no longer match.\n")
+
+    def report_timeout(self, out, test, example, timeout):
+        """
+        Report that the given example was killed after `timeout`
+        seconds.
+        """
+        out("Timed out after %g seconds.\n" % timeout)
+
+    def report_over_budget(self, out, test, example, seconds, budget):
+        """
+        Report that the given example took `seconds`, longer than its
+        `budget`.  If it is only a warning, say where the example is.
+        """
+        message = "took %.2f seconds, over the budget of %g seconds.\n" % (seconds, budget)
+        if self.over_budget != "warn":
+            out(message.capitalize())
+        elif test.filename and test.lineno is not None:
+            lineno = test.lineno + example.lineno + 1
+            out('File "%s", line %s: warning: %s' % (test.filename, lineno, message))
+        else:
+            out("Line %s, in %s: warning: %s" % (example.lineno + 1, test.name, message))
+
+    def report_document_over_budget(self, out, test, seconds, budget):
+        """
+        Report that the examples of `test` took `seconds` together,
+        longer than the document `budget`.
+        """
+        out(
+            "%s: %s%s took %.2f seconds, over the budget of %g seconds.\n"
+            % (
+                "Warning" if self.over_budget == "warn" else "Failure",
+                "document " if test.filename else "",
+                test.filename or test.name,
+                seconds,
+                budget,
+            )
+        )
+
     def report_unexpected_exception(self, out, test, example, exc_info):
         """
         Report that the given example raised an unexpected exception.
@@ -598,11 +1415,152 @@ class ScriptDocTestRunner(doctest.DocTestRunner):
         writer function `out`.  `compileflags` is the set of compiler
         flags that should be used to execute examples.  Return a tuple
         `(f, t)`, where `t` is the number of examples tried, and `f`
-        is the number of examples that failed.  The examples are run
-        in the namespace `test.globs`.
+        is the number of examples that failed.
+
+        Each section of `test` (see `ScriptDocTestParser`) is run in a
+        fresh workspace, with up to `section_jobs` of them at the same
+        time.  The outcomes are reported in document order.
+
+        If all examples together take longer than `document_budget`,
+        this counts as one more try, which failed.
+
+        This is a generator, like `_section_steps`.
         """
-        # Keep track of the number of failures and tries.
+        for listener in self.listeners:
+            listener.document_started(test)
+        began = time.perf_counter()
+        sections = []
+        for example in test.examples:
+            section = getattr(example, "section", 0)
+            if not sections or sections[-1][0] != section:
+                sections.append((section, []))
+            sections[-1][1].append(example)
+
+        failures = tries = 0
+        if self.section_jobs > 1 and len(sections) > 1:
+            failures, tries = yield self, "_run_sections", [test, sections, out], {}
+        else:
+            for i, (section, examples) in enumerate(sections):
+                f, t = yield from self._section_steps(
+                    test, examples, out, self._section_path(i), failures
+                )
+                failures += f
+                tries += t
+                if failures and self.optionflags & FAIL_FAST:
+                    break
+
+        seconds = time.perf_counter() - began
+        if self.document_budget is not None and seconds > self.document_budget:
+            self.report_document_over_budget(out, test, seconds, self.document_budget)
+            if self.over_budget == "fail":
+                failures += 1
+                tries += 1
+
+        # Record and return the number of failures and tries.
+        self.__record_outcome(test, failures, tries)
+        results = TestResults(failures, tries)
+        for listener in self.listeners:
+            listener.document_finished(test, results)
+        return results
+
+    def _run_sections(self, test, sections, out):
+        """
+        Run the `sections` of `test`, up to `section_jobs` of them at
+        the same time in threads, and report their outcomes in order.
+        Return a tuple `(f, t)` over all of them.
+        """
+        failures = tries = 0
+        with concurrent.futures.ThreadPoolExecutor(self.section_jobs) as executor:
+            futures = []
+            for i, (section, examples) in enumerate(sections):
+                reports = []
+                # Each section has its own option flags.
+                runner = copy.copy(self)
+                future = executor.submit(
+                    _run_steps,
+                    runner._section_steps(
+                        test, examples, reports.append, self._section_path(i)
+                    ),
+                )
+                futures.append((reports, future))
+            for reports, future in futures:
+                if future.cancelled():
+                    continue
+                f, t = future.result()
+                out("".join(reports))
+                failures += f
+                tries += t
+                if failures and self.optionflags & FAIL_FAST:
+                    for _, pending in futures:
+                        pending.cancel()
+        return failures, tries
+
+    async def _run_sections_async(self, test, sections, out):
+        """
+        Like `_run_sections`, with the sections as tasks of the event
+        loop.
+        """
+        limit = asyncio.Semaphore(self.section_jobs)
+        stopped = asyncio.Event()
+
+        async def run(runner, i, examples, reports):
+            async with limit:
+                if stopped.is_set():
+                    return None
+                return await _run_steps_async(
+                    runner._section_steps(
+                        test, examples, reports.append, self._section_path(i)
+                    )
+                )
+
         failures = tries = 0
+        tasks = []
+        try:
+            for i, (section, examples) in enumerate(sections):
+                reports = []
+                # Each section has its own option flags.
+                runner = copy.copy(self)
+                task = asyncio.ensure_future(run(runner, i, examples, reports))
+                tasks.append((reports, task))
+            for reports, task in tasks:
+                result = await task
+                if result is None:
+                    continue
+                f, t = result
+                out("".join(reports))
+                failures += f
+                tries += t
+                if failures and self.optionflags & FAIL_FAST:
+                    stopped.set()
+        finally:
+            for _, task in tasks:
+                task.cancel()
+            await asyncio.gather(*(task for _, task in tasks), return_exceptions=True)
+        return failures, tries
+
+    def _section_path(self, i):
+        """
+        Return the base path for the workspace of section `i`.
+        """
+        if self.directory is None or i == 0:
+            return self.directory
+        return "%s-section%d" % (self.directory.rstrip(os.sep), i)
+
+    def _section_steps(self, test, examples, out, base_path, failures=0):
+        """
+        Run `examples`, a section of `test`, in a new workspace at
+        `base_path`, and return a tuple `(f, t)` of the numbers of
+        failed and tried examples.  `failures` is the number of
+        failures before this section, for REPORT_ONLY_FIRST_FAILURE and
+        FAIL_FAST.
+
+        This is a generator, which yields the commands to run, and the
+        work on the files of the workspace, to `_run_steps` or
+        `_run_steps_async`.
+        """
+        # Keep track of the number of failures and tries.
+        previous_failures = failures
+        tries = 0
 
         # Save the option flags (since option directives can be used
         # to modify them).
@@ -611,158 +1569,424 @@ class ScriptDocTestRunner(doctest.DocTestRunner):
         SUCCESS, FAILURE, BOOM = range(3)  # `outcome` state
 
         check = self._checker.check_output
+        # Our checker takes the expected outputs as compiled by the parser.
+        precompiled = isinstance(self._checker, EllipsisOutputChecker)
+
+        testenvironment = yield _BLOCKING, "call", [
+            scripttest.TestFileEnvironment
+        ], dict(
+            base_path=base_path,
+            template_path=self.template,
+            tmpfs=self.tmpfs,
+            tmpfs_size=self.tmpfs_size,
+            pool=self.pool,
+            posix_spawn=self.posix_spawn,
+            track_changes=self.track_changes,
+            memory_limit=self.memory_limit,
+            cpu_limit=self.cpu_limit,
+        )
 
-        testenvironment = scripttest.TestFileEnvironment(base_path=self.directory)
-
-        # Process each example.
-        for examplenum, example in enumerate(test.examples):
-
-            # If REPORT_ONLY_FIRST_FAILURE is set, then suppress
-            # reporting after the first failure.
-            quiet = self.optionflags & REPORT_ONLY_FIRST_FAILURE and failures > 0
+        session = testenvironment.session() if self.session else None
+        pseudoshell = PseudoShell(testenvironment)
+
+        # The state of a shell session cannot be checkpointed.
+        checkpoints = self.checkpoints if session is None else None
+        keys = []
+        start = 0
+        if checkpoints is not None:
+            keys = checkpoints.keys(test, examples, original_optionflags)
+            resume = yield _BLOCKING, "call", [checkpoints.latest, keys], {}
+            if resume >= 0:
+                yield _BLOCKING, "call", [
+                    checkpoints.restore,
+                    keys[resume],
+                    testenvironment,
+                ], {}
+                start = resume + 1
+                # The examples up to there passed when the checkpoint
+                # was saved.
+                for example in examples[:start]:
+                    if not self._optionflags(example, original_optionflags) & SKIP:
+                        tries += 1
+                if self._verbose:
+                    self.report_resume(out, test, examples[resume])
+        saved = keys[start - 1] if start else None
+        if self.template and not start:
+            # A checkpoint already has the files of the template.
+            yield _BLOCKING, "call", [testenvironment.seed], {}
+
+        clock = time.perf_counter
 
-            # Merge in the example's options.
-            self.optionflags = original_optionflags
-            if example.options:
-                for (optionflag, val) in example.options.items():
-                    if val:
-                        self.optionflags |= optionflag
+        try:
+            # Process each example.
+            for i, example in enumerate(examples[start:], start):
+
+                # If REPORT_ONLY_FIRST_FAILURE is set, then suppress
+                # reporting after the first failure.
+                quiet = self.optionflags & REPORT_ONLY_FIRST_FAILURE and failures > 0
+
+                # Merge in the example's options.
+                self.optionflags = original_optionflags
+                if example.options:
+                    for (optionflag, val) in example.options.items():
+                        if val:
+                            self.optionflags |= optionflag
+                        else:
+                            self.optionflags &= ~optionflag
+
+                # If 'SKIP' is set, then skip this example.
+                if self.optionflags & SKIP:
+                    continue
+
+                # Record that we started this example.
+                tries += 1
+                began = clock()
+                if not quiet:
+                    self.report_start(out, test, example)
+
+                # Run the example in the given context (globs), and record
+                # any exception that gets raised.  (But don't intercept
+                # keyboard interrupts.)
+
+                if self.optionflags & CREATE_FILE_BEFORE_TEST:
+                    split = sh_split(example.source)
+                    if split[0] == "cat" and (
+                        len(split) == 2 or len(split) >= 3 and split[2].startswith("#")
+                    ):
+                        filename = split[1]
+                        with open(
+                            os.path.join(testenvironment.cwd, filename), "w"
+                        ) as file_to_write:
+                            file_to_write.write(example.want)
                     else:
-                        self.optionflags &= ~optionflag
-
-            # If 'SKIP' is set, then skip this example.
-            if self.optionflags & SKIP:
-                continue
-
-            # Record that we started this example.
-            tries += 1
-            if not quiet:
-                self.report_start(out, test, example)
-
-            # Run the example in the given context (globs), and record
-            # any exception that gets raised.  (But don't intercept
-            # keyboard interrupts.)
+                        raise ValueError(
+                            "Example requested file creation, "
+                            "which works only if the command is of the form "
+                            "`$ cat 'literal_filename'`",
+                            example.source,
+                        )
 
-            if self.optionflags & CREATE_FILE_BEFORE_TEST:
-                split = sh_split(example.source)
-                if split[0] == "cat" and (
-                    len(split) == 2 or len(split) >= 3 and split[2].startswith("#")
-                ):
-                    filename = split[1]
-                    with open(
-                        os.path.join(testenvironment.cwd, filename), "w"
-                    ) as file_to_write:
-                        file_to_write.write(example.want)
-                else:
-                    raise ValueError(
-                        "Example requested file creation, "
-                        "which works only if the command is of the form "
-                        "`$ cat 'literal_filename'`",
-                        example.source,
+                snapshot = self._snapshot(example)
+                if snapshot and snapshot is not True:
+                    # Settings name paths relative to the working directory.
+                    snapshot = os.path.relpath(
+                        os.path.join(testenvironment.cwd, snapshot),
+                        testenvironment.base_path,
                     )
 
-            by_python_pseudoshell = False
-            if self.optionflags & PSEUDOSHELL:
-                split = sh_split(example.source)
-                if split[0] == "cd" and (
-                    len(split) == 2 or len(split) > 2 and split[2].startswith("#")
-                ):
-                    dirname = os.path.join(testenvironment.cwd, split[1])
-                    if os.path.exists(dirname) and os.path.isdir(dirname):
-                        testenvironment.cwd = dirname
-                        got = ""
+                by_python_pseudoshell = False
+                if self.optionflags & PSEUDOSHELL and session is None:
+                    split = sh_split(example.source)
+                    if split[0] == "cd" and (
+                        len(split) == 2 or len(split) > 2 and split[2].startswith("#")
+                    ):
+                        dirname = os.path.join(testenvironment.cwd, split[1])
+                        if os.path.exists(dirname) and os.path.isdir(dirname):
+                            testenvironment.cwd = dirname
+                            got = ""
+                            by_python_pseudoshell = True
+                            exception = 0
+                    elif split[0] == "export" and (
+                        len(split) == 2 or len(split) > 2 and split[2].startswith("#")
+                    ):
+                        variable, value = split[1].split("=")
+                        testenvironment.environ[variable] = value
                         by_python_pseudoshell = True
+                        got = ""
                         exception = 0
-                elif split[0] == "export" and (
-                    len(split) == 2 or len(split) > 2 and split[2].startswith("#")
-                ):
-                    variable, value = split[1].split("=")
-                    testenvironment.environ[variable] = value
-                    by_python_pseudoshell = True
-                    got = ""
-                    exception = 0
-
-            if example.source.startswith("python -m") and (self.optionflags & COVERAGE):
-                data_file = os.path.abspath("./.coverage")
-                coverage_file = os.path.abspath("./.coveragerc")
-                with open(coverage_file, "w") as coveragerc:
-                    coveragerc.write(
-                        f"""[run]
+                    else:
+                        # Changes made in Python would not be seen by
+                        # the snapshots.
+                        got = yield _BLOCKING, "call", [
+                            pseudoshell.run,
+                            example.source,
+                        ], dict(change=not snapshot)
+                        if got is not None:
+                            by_python_pseudoshell = True
+                            exception = 0
+
+                if example.source.startswith("python -m") and (self.optionflags & COVERAGE):
+                    data_file = os.path.abspath("./.coverage")
+                    coverage_file = os.path.abspath("./.coveragerc")
+                    with open(coverage_file, "w") as coveragerc:
+                        coveragerc.write(
+                            f"""[run]
 branch=True
 data_file={data_file:}"""
+                        )
+                    example.source = example.source.replace(
+                        "python -m",
+                        f"coverage run -a --source lexedata --rcfile={coverage_file} -m",
                     )
-                example.source = example.source.replace(
-                    "python -m",
-                    f"coverage run -a --source lexedata --rcfile={coverage_file} -m",
-                )
-
-            if not by_python_pseudoshell:
-                # Don't blink!  This is where the user's code gets run.
-                try:
-                    # testenvironment does not run in shell mode. It's
-                    # better explicit than implicit anyway.
-                    output = testenvironment.run(
-                        "/bin/sh",
-                        "-c",
-                        example.source,
-                        expect_error=True,
-                        err_to_out=True,
-                    )
-
-                    self.debugger.set_continue()
-                    # ==== Example Finished ====
-                    exception = output.returncode
-                except KeyboardInterrupt:
-                    raise
 
-                got = output.stdout  # the actual output
-                self._fakeout.truncate(0)
-
-            outcome = FAILURE  # guilty until proven innocent or insane
-
-            # If the example executed without raising any exceptions,
-            # verify its output.
-            if exception == 0:
-                if check(example.want, got, self.optionflags):
-                    outcome = SUCCESS
+                want = example.want
+                if precompiled and isinstance(example, ScriptExample):
+                    want = example.matcher
+
+                watch = None
+                if self.early_abort and hasattr(self._checker, "output_watcher"):
+                    watch = self._checker.output_watcher(want, self.optionflags)
+                timeout = getattr(example, "settings", {}).get("TIMEOUT", self.timeout)
+
+                prepared = clock()
+                if not by_python_pseudoshell:
+                    # Don't blink!  This is where the user's code gets run.
+                    try:
+                        if session is not None:
+                            output = yield session, "run", [example.source], dict(
+                                snapshot=snapshot,
+                                watch=watch,
+                                timeout=timeout,
+                            )
+                        else:
+                            options = dict(
+                                expect_error=True,
+                                err_to_out=True,
+                                snapshot=snapshot,
+                                watch=watch,
+                                timeout=timeout,
+                            )
+                            output = None
+                            # Simple commands are run without a shell,
+                            # unless SHELL asks for one.
+                            argv = None
+                            if not self.optionflags & SHELL:
+                                argv = self._direct_argv(example.source, testenvironment)
+                            if argv is not None:
+                                try:
+                                    output = yield testenvironment, "run", argv, options
+                                except scripttest.SpawnError:
+                                    # Eg. a script without #!, which sh runs.
+                                    pass
+                                else:
+                                    if output.returncode < 0 and not (
+                                        output.timed_out or output.aborted
+                                    ):
+                                        # Killed by a signal, as sh reports it
+                                        output.returncode = 128 - output.returncode
+                            if output is None:
+                                # testenvironment does not run in shell mode. It's
+                                # better explicit than implicit anyway.
+                                output = yield testenvironment, "run", [
+                                    "/bin/sh",
+                                    "-c",
+                                    example.source,
+                                ], options
+
+                        self.debugger.set_continue()
+                        # ==== Example Finished ====
+                        exception = output.returncode
+                    except KeyboardInterrupt:
+                        raise
+
+                    # The actual output; our checker can take it undecoded.
+                    got = output.stdout_bytes if precompiled else None
+                    if got is None:
+                        got = output.stdout
+                    self._fakeout.truncate(0)
+                ran = clock()
+
+                outcome = FAILURE  # guilty until proven innocent or insane
+
+                aborted = not by_python_pseudoshell and output.aborted
+                timed_out = not by_python_pseudoshell and output.timed_out
+                # An example that was stopped, when its output could no
+                # longer match or it took too long, fails.
+                stopped = aborted or timed_out
+
+                # If the example executed without raising any exceptions,
+                # verify its output.
+                if exception == 0 and not stopped:
+                    if check(want, got, self.optionflags):
+                        outcome = SUCCESS
+
+                # The example raised an exception:  check if it was expected.
+                elif not stopped:
+                    if check(want, got, self.optionflags):
+                        outcome = SUCCESS
+
+                # Examples that merely took too long are not killed, but
+                # fail (or warn) afterwards.
+                budget = getattr(example, "settings", {}).get("BUDGET", self.budget)
+                over_budget = budget is not None and ran - began > budget
+                slow = over_budget and outcome is SUCCESS and self.over_budget == "fail"
+                if slow:
+                    outcome = FAILURE
+
+                if isinstance(got, bytes) and (outcome is not SUCCESS or self._verbose):
+                    got = output.stdout
+                checked = clock()
+
+                # Report the outcome.
+                if outcome is SUCCESS:
+                    if not quiet:
+                        self.report_success(out, test, example, got)
+                        if over_budget:
+                            self.report_over_budget(out, test, example, ran - began, budget)
+                elif outcome is FAILURE:
+                    if not quiet:
+                        if slow:
+                            # The output matched, don't show it.
+                            out(self._failure_header(test, example) + "\n")
+                        else:
+                            self.report_failure(out, test, example, got)
+                        if aborted:
+                            self.report_aborted(out, test, example)
+                        if timed_out:
+                            self.report_timeout(out, test, example, timeout)
+                        if over_budget:
+                            self.report_over_budget(out, test, example, ran - began, budget)
+                    failures += 1
+                elif outcome is BOOM:
+                    if not quiet:
+                        self.report_unexpected_exception(out, test, example, exception)
+                    failures += 1
+                else:
+                    assert False, ("unknown outcome", outcome)
 
-            # The example raised an exception:  check if it was expected.
-            else:
-                if check(example.want, got, self.optionflags):
-                    outcome = SUCCESS
+                if (
+                    snapshot
+                    and not by_python_pseudoshell
+                    and not quiet
+                    and (self._verbose or outcome is not SUCCESS)
+                ):
+                    self.report_files(out, test, example, output)
+                reported = clock()
 
-            # Report the outcome.
-            if outcome is SUCCESS:
-                if not quiet:
-                    self.report_success(out, test, example, got)
-            elif outcome is FAILURE:
-                if not quiet:
-                    self.report_failure(out, test, example, got)
-                failures += 1
-            elif outcome is BOOM:
-                if not quiet:
-                    self.report_unexpected_exception(out, test, example, exception)
-                failures += 1
-            else:
-                assert False, ("unknown outcome", outcome)
+                if testenvironment.in_ram and session is None:
+                    yield _BLOCKING, "call", [testenvironment.spill], {}
 
-            if failures and self.optionflags & FAIL_FAST:
-                break
+                if (
+                    checkpoints is not None
+                    and outcome is SUCCESS
+                    and failures == previous_failures
+                ):
+                    yield _BLOCKING, "call", [
+                        checkpoints.save,
+                        keys[i],
+                        testenvironment,
+                        saved,
+                    ], {}
+                    saved = keys[i]
+
+                if self.listeners:
+                    timings = {"prepare": prepared - began}
+                    if not by_python_pseudoshell:
+                        timings.update(output.timings)
+                        timings["run"] = ran - prepared - sum(output.timings.values())
+                    timings["check"] = checked - ran
+                    timings["report"] = reported - checked
+                    timings["checkpoint"] = clock() - reported
+                    if aborted:
+                        status = "aborted"
+                    elif timed_out:
+                        status = "timeout"
+                    elif slow:
+                        status = "over budget"
+                    else:
+                        status = "passed" if outcome is SUCCESS else "failed"
+                    if isinstance(got, bytes):
+                        got = output.stdout
+                    record = {
+                        "document": test.filename or test.name,
+                        "line": test.lineno + example.lineno + 1
+                        if test.filename and test.lineno is not None
+                        else example.lineno + 1,
+                        "command": example.source.rstrip("\n"),
+                        "status": status,
+                        "duration": clock() - began,
+                        "exit_code": exception,
+                        "output": got,
+                        "timings": timings,
+                    }
+                    for listener in self.listeners:
+                        listener.example_timings(test, example, timings)
+                        listener.example_finished(test, example, record)
+
+                if failures and self.optionflags & FAIL_FAST:
+                    break
+        finally:
+            if session is not None:
+                session.close()
+            testenvironment.close()
+            if self.pool is not None and (base_path is None or testenvironment.in_ram):
+                self.pool.discard(testenvironment.base_path)
+            elif testenvironment.in_ram:
+                yield _BLOCKING, "call", [
+                    shutil.rmtree,
+                    testenvironment.base_path,
+                ], dict(ignore_errors=True)
 
         # Restore the option flags (in case they were modified)
         self.optionflags = original_optionflags
 
-        # Record and return the number of failures and tries.
-        self.__record_outcome(test, failures, tries)
-        return TestResults(failures, tries)
+        if checkpoints is not None:
+            yield _BLOCKING, "call", [checkpoints.commit, test, examples, keys], {}
 
-    def __record_outcome(self, test, f, t):
+        return failures - previous_failures, tries
+
+    @staticmethod
+    def _optionflags(example, optionflags):
+        """
+        Return `optionflags` with the options of `example` merged in.
+        """
+        for (optionflag, val) in example.options.items():
+            if val:
+                optionflags |= optionflag
+            else:
+                optionflags &= ~optionflag
+        return optionflags
+
+    @staticmethod
+    def _direct_argv(source, testenvironment):
+        """
+        Return the arguments to run `source` with directly, without a
+        shell, or None if it needs a shell: If it uses any shell
+        syntax besides words, quotes and a comment, if it starts with
+        an assignment or a shell builtin, or if its program is not
+        found in the `testenvironment`.
+        """
+        argv = simple_argv(source)
+        if argv is None or argv[0] in SHELL_BUILTINS or "=" in argv[0]:
+            return None
+        if len(argv) == 1 and " " in argv[0]:
+            # `run` would split it.
+            return None
+        if os.sep in argv[0]:
+            program = os.path.join(testenvironment.cwd, argv[0])
+            if not (os.path.isfile(program) and os.access(program, os.X_OK)):
+                return None
+        elif not shutil.which(argv[0], path=testenvironment.environ.get("PATH", os.defpath)):
+            return None
+        return argv
+
+    def _snapshot(self, example):
+        """
+        Return the snapshot policy (see `TestFileEnvironment.run`) for
+        running `example` under the current option flags.
+        """
+        subtree = getattr(example, "settings", {}).get("SNAPSHOT")
+        if subtree:
+            return subtree
+        if self.optionflags & SNAPSHOT:
+            return True
+        return self.snapshot
+
+    def __record_outcome(self, test, f, t):
         """
         Record the fact that the given DocTest (`test`) generated `f`
         failures out of `t` tried examples.
         """
-        f2, t2 = self._name2ft.get(test.name, (0, 0))
-        self._name2ft[test.name] = (f + f2, t + t2)
+        self.record_outcome(test.name, f, t)
+
+    def record_outcome(self, name, f, t):
+        """
+        Record the fact that the DocTest called `name` generated `f`
+        failures out of `t` tried examples, eg. when it was run by
+        another runner.
+        """
+        f2, t2 = self._name2ft.get(name, (0, 0))
+        self._name2ft[name] = (f + f2, t + t2)
         self.failures += f
         self.tries += t
 
@@ -792,15 +2016,7 @@ data_file={data_file:}"""
             compileflags = _extract_future_flags(test.globs)
 
         save_stdout = sys.stdout
-        if out is None:
-            encoding = save_stdout.encoding
-            if encoding is None or encoding.lower() == "utf-8":
-                out = save_stdout.write
-            else:
-                # Use backslashreplace error handling on write
-                def out(s):
-                    s = str(s.encode(encoding, "backslashreplace"), encoding)
-                    save_stdout.write(s)
+        out = self._writer(out)
 
         sys.stdout = self._fakeout
 
@@ -825,7 +2041,7 @@ data_file={data_file:}"""
         sys.displayhook = sys.__displayhook__
 
         try:
-            return self.__run(test, compileflags, out)
+            return _run_steps(self.__run(test, compileflags, out))
         finally:
             sys.stdout = save_stdout
             pdb.set_trace = save_set_trace
@@ -833,16 +2049,852 @@ data_file={data_file:}"""
             linecache.getlines = self.save_linecache_getlines
             sys.displayhook = save_displayhook
             if clear_globs:
-                test.globs.clear()
-                try:
-                    import builtins
+                self._clear_globs(test)
+
+    async def run_async(self, test, compileflags=None, out=None, clear_globs=True):
+        """
+        Like `run`, but a coroutine, which runs the commands of the
+        examples with `TestFileEnvironment.run_async`, so that the
+        event loop can run other tests while they run.  Each test
+        that runs at the same time needs a runner of its own.
+
+        Unlike `run`, this leaves `sys.stdout`, `pdb.set_trace` and
+        `linecache` alone, since the other tests share them.
+        """
+        self.test = test
+
+        if compileflags is None:
+            compileflags = _extract_future_flags(test.globs)
+
+        out = self._writer(out)
+        self.debugger = _OutputRedirectingPdb(sys.stdout)
+        self.debugger.reset()
+
+        try:
+            return await _run_steps_async(self.__run(test, compileflags, out))
+        finally:
+            if clear_globs:
+                self._clear_globs(test)
+
+    @staticmethod
+    def _writer(out):
+        """
+        Return the writer function `out`, or by default one that
+        writes to `sys.stdout`.
+        """
+        if out is not None:
+            return out
+        save_stdout = sys.stdout
+        encoding = save_stdout.encoding
+        if encoding is None or encoding.lower() == "utf-8":
+            return save_stdout.write
+
+        # Use backslashreplace error handling on write
+        def out(s):
+            s = str(s.encode(encoding, "backslashreplace"), encoding)
+            save_stdout.write(s)
+
+        return out
+
+    @staticmethod
+    def _clear_globs(test):
+        test.globs.clear()
+        try:
+            import builtins
+
+            builtins._ = None
+        except ImportError:
+            pass
+
+
+class Listener(object):
+    """
+    The interface of the listeners of `ScriptDocTestRunner`, which does
+    nothing.  Subclasses override the methods for the events they are
+    interested in.
+
+    `example_finished` receives a record of each example that was run,
+    a dictionary with the keys
+
+    ``document``: the file name of the document (or its name)
+    ``line``: the line of the example in it, counting from 1
+    ``command``: the source of the example
+    ``status``: ``passed``, ``failed``, ``timeout``, ``aborted`` or
+        ``over budget``
+    ``duration``: the seconds the example took, in total
+    ``exit_code``: the exit code of the command
+    ``output``: the output of the command, as a string
+    ``timings``: the seconds spent in each phase, see `example_timings`
+
+    Sections of a document may be run in different threads, see
+    `section_jobs`, so the methods must be thread safe.  For `testfiles`
+    with several jobs, the listeners are pickled to the worker
+    processes, and the copies are passed back to `merge` when each
+    document is done.
+    """
+
+    def document_started(self, test):
+        pass
+
+    def example_timings(self, test, example, timings):
+        pass
+
+    def example_finished(self, test, example, record):
+        pass
+
+    def document_finished(self, test, results):
+        pass
+
+    def merge(self, other):
+        """Take over what the copy `other` recorded in a worker."""
+
+    def close(self):
+        """Finish the output, when all documents are done."""
+
+    def report(self, out=None):
+        """Write a summary of what was recorded to `out`."""
+
+
+class PhaseBreakdown(Listener):
+    """
+    A listener for `ScriptDocTestRunner` that adds up the time spent in
+    each phase of the examples, and reports how much of it went to the
+    commands themselves, and how much to the harness around them.
+    """
+
+    # The phase in which the commands run; all others are overhead.
+    COMMAND = "command"
+
+    def __init__(self):
+        self.examples = 0
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def example_timings(self, test, example, timings):
+        with self._lock:
+            self.examples += 1
+            for phase, seconds in timings.items():
+                self.totals[phase] = self.totals.get(phase, 0.0) + seconds
+
+    def merge(self, other):
+        """Add the timings recorded by `other` to these."""
+        with self._lock:
+            self.examples += other.examples
+            for phase, seconds in other.totals.items():
+                self.totals[phase] = self.totals.get(phase, 0.0) + seconds
+
+    def report(self, out=None):
+        """Write the breakdown to `out`, by default `sys.stdout.write`."""
+        out = out or sys.stdout.write
+        total = sum(self.totals.values()) or 1.0
+        examples = self.examples or 1
+        out("%-16s %12s %14s %7s\n" % ("phase", "total [s]", "per example [ms]", "share"))
+        for phase, seconds in self.totals.items():
+            out(
+                "%-16s %12.3f %14.3f %6.1f%%\n"
+                % (phase, seconds, seconds / examples * 1000, seconds / total * 100)
+            )
+        command = self.totals.get(self.COMMAND, 0.0)
+        out(
+            "%d examples: %.3fs in commands (%.1f%%), %.3fs harness overhead (%.1f%%)\n"
+            % (
+                self.examples,
+                command,
+                command / total * 100,
+                total - command,
+                (total - command) / total * 100,
+            )
+        )
+
+
+class SlowestExamples(Listener):
+    """
+    A listener that keeps the `n` examples and documents that took the
+    longest, and reports them, like the ``--durations`` of pytest.
+    """
+
+    def __init__(self, n=10):
+        self.n = n
+        self.examples = []  # heaps of (seconds, ...)
+        self.documents = []
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _keep(self, heap, item):
+        with self._lock:
+            if len(heap) < self.n:
+                heapq.heappush(heap, item)
+            else:
+                heapq.heappushpop(heap, item)
+
+    def document_started(self, test):
+        self._started[test.name] = time.perf_counter()
+
+    def example_finished(self, test, example, record):
+        self._keep(
+            self.examples,
+            (record["duration"], record["document"], record["line"], record["command"]),
+        )
+
+    def document_finished(self, test, results):
+        seconds = time.perf_counter() - self._started.pop(test.name)
+        self._keep(self.documents, (seconds, test.filename or test.name))
+
+    def merge(self, other):
+        for item in other.examples:
+            self._keep(self.examples, item)
+        for item in other.documents:
+            self._keep(self.documents, item)
+
+    def report(self, out=None):
+        """Write the slowest examples and documents to `out`."""
+        out = out or sys.stdout.write
+        if not self.n:
+            return
+        out("%d slowest examples:\n" % len(self.examples))
+        for seconds, document, line, command in sorted(self.examples, reverse=True):
+            out(
+                "%8.3fs  %s, line %s: $ %s\n"
+                % (seconds, document, line, command.split("\n")[0])
+            )
+        out("%d slowest documents:\n" % len(self.documents))
+        for seconds, document in sorted(self.documents, reverse=True):
+            out("%8.3fs  %s\n" % (seconds, document))
+
+
+######################################################################
+# 6. Result Cache
+######################################################################
+
+
+class ResultCache(object):
+    """
+    An on-disk cache of the documents that passed, so they need not be
+    run again while nothing they depend on has changed.
+
+    The key of a document is a hash of its text, the option flags, the
+    values of the environment variables named in `environ`, and the
+    contents of the files (or directory trees, or programs on the
+    `PATH`) named in `dependencies`.
+
+    If `force` is true, documents are always run, but passes are still
+    recorded.
+    """
+
+    VERSION = 1
+
+    def __init__(self, directory, environ=(), dependencies=(), force=False):
+        self.directory = directory
+        self.environ = sorted(environ)
+        self.dependencies = list(dependencies)
+        self.force = force
+        self._dependency_digest = None
+        self._tree_digests = {}
+
+    def dependency_digest(self):
+        """
+        Return the hash of the contents of all dependencies. It is
+        computed only once.
+        """
+        if self._dependency_digest is None:
+            digest = hashlib.sha256()
+            for dependency in self.dependencies:
+                path = dependency
+                if not os.path.exists(path):
+                    path = shutil.which(dependency) or path
+                digest.update(dependency.encode("utf-8") + b"\0")
+                self._update_tree_digest(digest, path)
+            self._dependency_digest = digest.hexdigest()
+        return self._dependency_digest
+
+    def tree_digest(self, path):
+        """
+        Return the hash of the contents of the file or directory tree
+        at `path`, eg. a template.  It is computed only once per path.
+        """
+        path = os.path.abspath(path)
+        if path not in self._tree_digests:
+            digest = hashlib.sha256()
+            self._update_tree_digest(digest, path)
+            self._tree_digests[path] = digest.hexdigest()
+        return self._tree_digests[path]
+
+    @classmethod
+    def _update_tree_digest(cls, digest, path):
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = sorted(d for d in dirnames if d != "__pycache__")
+                for filename in sorted(filenames):
+                    full = os.path.join(dirpath, filename)
+                    digest.update(os.path.relpath(full, path).encode("utf-8"))
+                    digest.update(cls._file_digest(full))
+        elif os.path.exists(path):
+            digest.update(cls._file_digest(path))
+        else:
+            digest.update(b"missing")
+
+    @staticmethod
+    def _file_digest(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.digest()
+
+    def key(self, text, optionflags=0, **options):
+        """
+        Return the cache key of a document with the given `text`, run
+        with the given `optionflags` and further runner `options`.
+        """
+        digest = hashlib.sha256()
+        flags = sorted(
+            name for name, flag in OPTIONFLAGS_BY_NAME.items() if optionflags & flag
+        )
+        for part in (
+            str(self.VERSION),
+            text,
+            " ".join(flags),
+            repr(sorted(options.items())),
+            repr([(name, os.environ.get(name)) for name in self.environ]),
+            self.dependency_digest(),
+        ):
+            digest.update(part.encode("utf-8") + b"\0")
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key):
+        """
+        Return the record of the passing run with the given `key`, or
+        None if there is none (or `force` is set).
+        """
+        if self.force:
+            return None
+        path = self._path(key)
+        try:
+            with open(path) as record:
+                result = json.load(record)
+        except (OSError, ValueError):
+            return None
+        # Used entries are kept by `prune`.
+        os.utime(path)
+        return result
+
+    def put(self, key, name, tries):
+        """
+        Record that the document called `name` passed `tries` examples.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = "%s.%d" % (path, os.getpid())
+        with open(temporary, "w") as record:
+            json.dump({"name": name, "tries": tries, "time": time.time()}, record)
+        os.replace(temporary, path)
+
+    def prune(self, max_age):
+        """
+        Remove the entries not used for `max_age` seconds. Return the
+        number of removed entries.
+        """
+        removed = 0
+        limit = time.time() - max_age
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if filename.endswith(".json") and os.path.getmtime(path) < limit:
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+
+######################################################################
+# 7. Checkpoints
+######################################################################
+
+
+class CheckpointStore(object):
+    """
+    Snapshots of the workspace after each passing example, so that a
+    later run of an edited document can resume after the last example
+    that did not change, instead of replaying all of them.
+
+    A checkpoint is keyed by a hash of the document name, the section,
+    the option flags and all examples of the section up to that point,
+    so an unchanged key means an unchanged sequence of examples. It
+    contains a copy of the workspace (files unchanged since the
+    previous checkpoint are hard links to its copy, the others are
+    reflinks where the filesystem allows, or plain copies), and the
+    working directory and environment variables of the
+    `TestFileEnvironment`.
+
+    Checkpoints of a section that are not part of its latest run are
+    removed.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        # Stat results of the workspace files at the last save, per
+        # workspace, to find the files that are unchanged since then.
+        self._saved = {}
+
+    def keys(self, test, examples, optionflags):
+        """
+        Return the list of checkpoint keys for `examples`, the examples
+        of a section of `test`.
+        """
+        digest = hashlib.sha256()
+        digest.update(("%s\0%d" % (self._section_id(test, examples), optionflags)).encode("utf-8"))
+        keys = []
+        for example in examples:
+            for part in (
+                example.source,
+                example.want,
+                repr(sorted(example.options.items())),
+                repr(sorted(getattr(example, "settings", {}).items())),
+            ):
+                digest.update(part.encode("utf-8") + b"\0")
+            keys.append(digest.hexdigest())
+        return keys
+
+    @staticmethod
+    def _section_id(test, examples):
+        section = getattr(examples[0], "section", 0) if examples else 0
+        return hashlib.sha256(("%s\0%d" % (test.name, section)).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def latest(self, keys):
+        """
+        Return the index of the last of `keys` with a checkpoint, or -1.
+        """
+        for i in range(len(keys) - 1, -1, -1):
+            if os.path.exists(os.path.join(self._path(keys[i]), "meta.json")):
+                return i
+        return -1
+
+    def save(self, key, env, previous=None):
+        """
+        Save the workspace of `env` as checkpoint `key`. `previous` is
+        the key of the previous checkpoint of the same workspace.
+        """
+        final = self._path(key)
+        if os.path.exists(final):
+            return
+        path = "%s.tmp%d" % (final, os.getpid())
+        tree = os.path.join(path, "tree")
+        os.makedirs(tree)
+        saved = self._saved.get(env.base_path, {}) if previous else {}
+        previous_tree = previous and os.path.join(self._path(previous), "tree")
+        stats = {}
+        for dirpath, dirnames, filenames in os.walk(env.base_path):
+            rel = os.path.relpath(dirpath, env.base_path)
+            for dirname in list(dirnames):
+                full = os.path.join(dirpath, dirname)
+                if os.path.islink(full):
+                    # Copied as a link, not followed.
+                    dirnames.remove(dirname)
+                    filenames.append(dirname)
+                else:
+                    os.mkdir(os.path.join(tree, rel, dirname))
+            for filename in filenames:
+                full = os.path.join(dirpath, filename)
+                relfile = os.path.normpath(os.path.join(rel, filename))
+                target = os.path.join(tree, relfile)
+                if os.path.islink(full):
+                    os.symlink(os.readlink(full), target)
+                    continue
+                st = os.stat(full)
+                stats[relfile] = stat = (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+                if saved.get(relfile) == stat:
+                    try:
+                        os.link(os.path.join(previous_tree, relfile), target)
+                        continue
+                    except OSError:
+                        pass
+                scripttest.clone_file(full, target)
+        cwd = os.path.relpath(env.cwd, env.base_path)
+        environ = dict(
+            (k, v) for k, v in env.environ.items() if os.environ.get(k) != v
+        )
+        removed = [k for k in os.environ if k not in env.environ]
+        with open(os.path.join(path, "meta.json"), "w") as meta:
+            json.dump({"cwd": cwd, "environ": environ, "removed": removed}, meta)
+        try:
+            os.rename(path, final)
+        except OSError:
+            # Somebody else saved it in the meantime.
+            shutil.rmtree(path, ignore_errors=True)
+        self._saved[env.base_path] = stats
+
+    def restore(self, key, env):
+        """
+        Replace the workspace of `env` with checkpoint `key`.
+        """
+        env.clear()
+        path = self._path(key)
+        tree = os.path.join(path, "tree")
+        for dirpath, dirnames, filenames in os.walk(tree):
+            rel = os.path.relpath(dirpath, tree)
+            for dirname in dirnames:
+                os.makedirs(os.path.join(env.base_path, rel, dirname), exist_ok=True)
+            for filename in filenames:
+                full = os.path.join(dirpath, filename)
+                target = os.path.normpath(os.path.join(env.base_path, rel, filename))
+                if os.path.lexists(target):
+                    os.remove(target)
+                if os.path.islink(full):
+                    os.symlink(os.readlink(full), target)
+                else:
+                    scripttest.clone_file(full, target)
+        with open(os.path.join(path, "meta.json")) as meta:
+            meta = json.load(meta)
+        env.cwd = os.path.normpath(os.path.join(env.base_path, meta["cwd"]))
+        env.environ.clear()
+        env.environ.update(os.environ)
+        env.environ.update(meta["environ"])
+        for k in meta["removed"]:
+            env.environ.pop(k, None)
+        self._saved.pop(env.base_path, None)
+
+    def commit(self, test, examples, keys):
+        """
+        Remove the checkpoints of this section of `test` that are not
+        in `keys`, ie. those of older versions of the section.
+        """
+        index = os.path.join(self.directory, "index")
+        os.makedirs(index, exist_ok=True)
+        name = os.path.join(index, self._section_id(test, examples))
+        try:
+            with open(name) as old:
+                old = json.load(old)
+        except (OSError, ValueError):
+            old = []
+        for key in set(old) - set(keys):
+            shutil.rmtree(self._path(key), ignore_errors=True)
+        with open(name, "w") as new:
+            json.dump(keys, new)
+
+
+######################################################################
+# 8. Parse Cache
+######################################################################
+
+
+class ParseCache(object):
+    """
+    An on-disk cache of the examples parsed from documents, so that
+    unchanged documents need not be parsed again.
+
+    The key of a document is a hash of its text, the parser class and
+    the source of the module that defines it, and the registered option
+    flags and settings. The examples are stored as JSON lists of their
+    attributes.
+    """
+
+    VERSION = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._parser_digests = {}
+
+    def _parser_digest(self, parser):
+        """Return the hash of the class and module source of `parser`."""
+        cls = type(parser)
+        if cls not in self._parser_digests:
+            digest = hashlib.sha256()
+            digest.update(("%s.%s" % (cls.__module__, cls.__qualname__)).encode("utf-8"))
+            source = getattr(sys.modules.get(cls.__module__), "__file__", None)
+            if source is not None:
+                digest.update(ResultCache._file_digest(source))
+            self._parser_digests[cls] = digest.hexdigest()
+        return self._parser_digests[cls]
+
+    def key(self, parser, text):
+        """
+        Return the cache key of a document with the given `text`, parsed
+        by `parser`.
+        """
+        digest = hashlib.sha256()
+        for part in (
+            str(self.VERSION),
+            self._parser_digest(parser),
+            repr(sorted(OPTIONFLAGS_BY_NAME.items())),
+            repr(sorted((name, repr(convert)) for name, convert in SETTINGS_BY_NAME.items())),
+            text,
+        ):
+            digest.update(part.encode("utf-8") + b"\0")
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get_examples(self, parser, text, name="<string>"):
+        """
+        Return the examples of `text` as `parser.get_examples` does,
+        from the cache if possible. Documents whose examples cannot be
+        stored (eg. because a setting has a value that JSON does not
+        support) are parsed every time.
+        """
+        key = self.key(parser, text)
+        path = self._path(key)
+        try:
+            with open(path) as record:
+                rows = json.load(record)
+        except (OSError, ValueError):
+            pass
+        else:
+            examples = []
+            for source, want, exc_msg, lineno, indent, options, settings, section in rows:
+                examples.append(
+                    ScriptExample(
+                        source, want, exc_msg, lineno, indent, dict(options), settings, section
+                    )
+                )
+            return examples
+
+        examples = parser.get_examples(text, name)
+        try:
+            record = json.dumps(
+                [
+                    [
+                        example.source,
+                        example.want,
+                        example.exc_msg,
+                        example.lineno,
+                        example.indent,
+                        sorted(example.options.items()),
+                        example.settings,
+                        example.section,
+                    ]
+                    for example in examples
+                ],
+                separators=(",", ":"),
+            )
+        except (AttributeError, TypeError, ValueError):
+            return examples
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = "%s.%d" % (path, os.getpid())
+        with open(temporary, "w") as out:
+            out.write(record)
+        os.replace(temporary, path)
+        return examples
+
+    def get_doctest(self, parser, string, globs, name, filename, lineno):
+        """
+        Like `parser.get_doctest`, but with the examples from
+        `get_examples`.
+        """
+        return doctest.DocTest(
+            self.get_examples(parser, string, name), globs, name, filename, lineno, string
+        )
+
+
+
+######################################################################
+# 9. Reports
+######################################################################
+
+
+class ReportWriter(Listener):
+    """
+    A listener that writes a record of each example as soon as the
+    example is finished, so that nothing is held in memory.  Outputs
+    longer than `max_output` characters are truncated in the middle.
+
+    The records of each document are written to a part file next to
+    `path`, which is appended to `path` when the document is done, so
+    that the records of documents run at the same time (see
+    `testfiles_async`) do not mix.  Likewise, in worker processes (see
+    `testfiles`), everything is written to a part file of the worker,
+    which `merge` appends to `path`.  `close` must be called at the end.
+    """
+
+    def __init__(self, path, max_output=4096):
+        self.path = path
+        self.max_output = max_output
+        self._part = None
+        self._documents = {}  # id(test): (path, file) of its part
+        self._lock = threading.Lock()
+        self._file = open(path, "w", encoding="utf-8")
+        self.begin()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"], state["_file"], state["_documents"]
+        if self._part is not None:
+            # A copy going back from a worker: its part is finished.
+            self._file.close()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._documents = {}
+        self._file = None
+        if self._part is None:
+            # A copy going to a worker: write to a part file of its own.
+            self._part, self._file = self._open_part()
+
+    def _open_part(self):
+        """Create a part file next to `path`; return its path and file."""
+        fd, part = tempfile.mkstemp(
+            prefix=os.path.basename(self.path) + ".",
+            suffix=".part",
+            dir=os.path.dirname(os.path.abspath(self.path)),
+        )
+        return part, open(fd, "w", encoding="utf-8")
+
+    def _append(self, part):
+        """Append the part file at `part` to the file, and remove it."""
+        with open(part, encoding="utf-8") as f:
+            with self._lock:
+                shutil.copyfileobj(f, self._file)
+                self._file.flush()
+        os.remove(part)
+
+    def write(self, text, test=None):
+        """Write `text`, to the part of the document `test` if it runs."""
+        with self._lock:
+            document = self._documents.get(id(test))
+            if document is not None:
+                document[1].write(text)
+            else:
+                self._file.write(text)
+                self._file.flush()
+
+    def document_started(self, test):
+        document = self._open_part()
+        with self._lock:
+            self._documents[id(test)] = document
+
+    def document_finished(self, test, results):
+        with self._lock:
+            part, f = self._documents.pop(id(test))
+        f.close()
+        self._append(part)
+
+    def truncate(self, output):
+        """Return `output`, cut to `max_output` characters."""
+        if output is None or len(output) <= self.max_output:
+            return output
+        half = self.max_output // 2
+        return "%s\n[... %d characters ...]\n%s" % (
+            output[:half],
+            len(output) - 2 * half,
+            output[len(output) - half :],
+        )
 
-                    builtins._ = None
-                except ImportError:
-                    pass
+    def merge(self, other):
+        self._append(other._part)
 
+    def begin(self):
+        """Write the start of the report."""
 
-master = None
+    def end(self):
+        """Write the end of the report."""
+
+    def close(self):
+        # Documents that were stopped before they were done are left
+        # out, rather than left unfinished.
+        for part, f in self._documents.values():
+            f.close()
+            os.remove(part)
+        self._documents.clear()
+        self.end()
+        self._file.close()
+
+
+class JSONLinesReporter(ReportWriter):
+    """
+    Write the record of each example (see `Listener`) as a line of
+    JSON, with the output truncated.
+    """
+
+    def example_finished(self, test, example, record):
+        record = dict(record, output=self.truncate(record["output"]))
+        self.write(json.dumps(record, ensure_ascii=False) + "\n", test)
+
+
+class JUnitReporter(ReportWriter):
+    """
+    Write the examples as JUnit XML: a ``testsuite`` for each document
+    and a ``testcase`` for each example, with a ``failure`` element if
+    it did not pass.  The elements are written as the examples finish,
+    so the test suites have no counts of tests and failures.
+    """
+
+    # Characters that XML 1.0 does not allow, eg. terminal escapes
+    _INVALID_RE = re.compile("[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]")
+
+    @classmethod
+    def escape(cls, text):
+        return xml.sax.saxutils.escape(cls._INVALID_RE.sub("\ufffd", text))
+
+    @classmethod
+    def attribute(cls, text):
+        return xml.sax.saxutils.quoteattr(cls._INVALID_RE.sub("\ufffd", text))
+
+    def begin(self):
+        self.write('<?xml version="1.0" encoding="utf-8"?>\n<testsuites>\n')
+
+    def document_started(self, test):
+        ReportWriter.document_started(self, test)
+        self.write(
+            "  <testsuite name=%s>\n" % self.attribute(test.filename or test.name), test
+        )
+
+    def example_finished(self, test, example, record):
+        parts = [
+            "    <testcase classname=%s name=%s file=%s line=\"%d\" time=\"%.6f\">\n"
+            % (
+                self.attribute(record["document"]),
+                self.attribute(
+                    "line %d: %s" % (record["line"], record["command"].split("\n")[0])
+                ),
+                self.attribute(record["document"]),
+                record["line"],
+                record["duration"],
+            )
+        ]
+        if record["status"] != "passed":
+            parts.append(
+                "      <failure message=%s>%s</failure>\n"
+                % (
+                    self.attribute(
+                        "%s (exit code %s)" % (record["status"], record["exit_code"])
+                    ),
+                    self.escape("$ %s\n%s" % (record["command"], self.truncate(record["output"]))),
+                )
+            )
+        parts.append("    </testcase>\n")
+        self.write("".join(parts), test)
+
+    def document_finished(self, test, results):
+        self.write("  </testsuite>\n", test)
+        ReportWriter.document_finished(self, test, results)
+
+    def end(self):
+        self.write("</testsuites>\n")
 
 
 def testfile(
@@ -859,6 +2911,27 @@ def testfile(
     parser=ScriptDocTestParser(),
     encoding=None,
     base_path=None,
+    snapshot=False,
+    track_changes=False,
+    session=False,
+    section_jobs=1,
+    out=None,
+    cache=None,
+    checkpoints=None,
+    early_abort=False,
+    timeout=None,
+    memory_limit=None,
+    cpu_limit=None,
+    parse_cache=None,
+    listeners=None,
+    budget=None,
+    document_budget=None,
+    over_budget="fail",
+    template=None,
+    tmpfs=None,
+    tmpfs_size=None,
+    pool=None,
+    posix_spawn=False,
 ):
     """
     Test examples in the given file.  Return (#failures, #tests).
@@ -928,16 +3001,151 @@ def testfile(
     Optional keyword arg "encoding" specifies an encoding that should
     be used to convert the file to unicode.
 
-    Advanced tomfoolery:  testmod runs methods of a local instance of
-    class doctest.Tester, then merges the results into (or creates)
-    global Tester instance doctest.master.  Methods of doctest.master
-    can be called directly too, if you want to do something unusual.
-    Passing report=0 to testmod is especially useful then, to delay
-    displaying a summary.  Invoke doctest.master.summarize(verbose)
-    when you're done fiddling.
+    Optional keyword arg "base_path" gives the directory the examples
+    are run in; by default, a new temporary directory is used.
+
+    Optional keyword arg "snapshot" says which files to check for
+    changes around each example, and "track_changes" whether to use
+    inotify for that; see `ScriptDocTestRunner`.
+
+    Optional keyword arg "session" runs all examples in one shell
+    process, and "section_jobs" how many sections of the document may
+    run at the same time; see `ScriptDocTestRunner`.
+
+    Optional keyword arg "out" is the function the test report is
+    written to; by default, `sys.stdout.write`.
+
+    Optional keyword arg "cache" is a `ResultCache`. If it has a
+    passing run of the file with the same key, the file is not run
+    but counted as passed; otherwise a pass is recorded in it.
+
+    Optional keyword arg "checkpoints" is a `CheckpointStore` to save
+    the workspace after each example in, and to resume from; see
+    `ScriptDocTestRunner`.
+
+    Optional keyword arg "early_abort" kills examples as soon as their
+    output can no longer match; see `ScriptDocTestRunner`.
+
+    Optional keyword args "timeout" (in seconds), "memory_limit" (in
+    bytes) and "cpu_limit" (in seconds) limit the resources of each
+    example; see `ScriptDocTestRunner`.
+
+    Optional keyword arg "parse_cache" is a `ParseCache` to take the
+    examples of the file from, if it was parsed before.
+
+    Optional keyword arg "listeners" is a list of `Listener` objects
+    that receive the timings and outcome of each example, eg. to write
+    them to a `JSONLinesReporter` or `JUnitReporter`; see
+    `ScriptDocTestRunner`.
+
+    Optional keyword args "budget" and "document_budget" give the
+    seconds each example and the whole file may take, and
+    "over_budget" whether to "fail" or "warn" if they take longer; see
+    `ScriptDocTestRunner`.
+
+    Optional keyword arg "template" is a directory to copy into the
+    workspace before the examples run; see `ScriptDocTestRunner`.
+
+    Optional keyword args "tmpfs" and "tmpfs_size" put the workspace in
+    RAM, if there is no "base_path"; see `ScriptDocTestRunner`.
+
+    Optional keyword arg "pool" is a `scripttest.WorkspacePool` that
+    provides and deletes the workspaces; see `ScriptDocTestRunner`.
+
+    Optional keyword arg "posix_spawn" starts the examples with
+    `posix_spawn` where possible; see `ScriptDocTestRunner`.
+
+    The results are not merged into a global runner; to summarize
+    several files, use `testfiles`, or `ScriptDocTestRunner.record_outcome`.
     """
-    global master
+    return _run_steps(
+        _testfile_steps(
+            filename,
+            module_relative=module_relative,
+            name=name,
+            package=package,
+            globs=globs,
+            verbose=verbose,
+            report=report,
+            optionflags=optionflags,
+            extraglobs=extraglobs,
+            raise_on_error=raise_on_error,
+            parser=parser,
+            encoding=encoding,
+            base_path=base_path,
+            snapshot=snapshot,
+            track_changes=track_changes,
+            session=session,
+            section_jobs=section_jobs,
+            out=out,
+            cache=cache,
+            checkpoints=checkpoints,
+            early_abort=early_abort,
+            timeout=timeout,
+            memory_limit=memory_limit,
+            cpu_limit=cpu_limit,
+            parse_cache=parse_cache,
+            listeners=listeners,
+            budget=budget,
+            document_budget=document_budget,
+            over_budget=over_budget,
+            template=template,
+            tmpfs=tmpfs,
+            tmpfs_size=tmpfs_size,
+            pool=pool,
+            posix_spawn=posix_spawn,
+        )
+    )
+
+
+async def testfile_async(filename, **kwargs):
+    """
+    Like `testfile`, with the same arguments, but a coroutine, which
+    runs the examples with `ScriptDocTestRunner.run_async`.
+    """
+    return await _run_steps_async(_testfile_steps(filename, **kwargs))
+
 
+def _testfile_steps(
+    filename,
+    module_relative=True,
+    name=None,
+    package=None,
+    globs=None,
+    verbose=None,
+    report=True,
+    optionflags=0,
+    extraglobs=None,
+    raise_on_error=False,
+    parser=ScriptDocTestParser(),
+    encoding=None,
+    base_path=None,
+    snapshot=False,
+    track_changes=False,
+    session=False,
+    section_jobs=1,
+    out=None,
+    cache=None,
+    checkpoints=None,
+    early_abort=False,
+    timeout=None,
+    memory_limit=None,
+    cpu_limit=None,
+    parse_cache=None,
+    listeners=None,
+    budget=None,
+    document_budget=None,
+    over_budget="fail",
+    template=None,
+    tmpfs=None,
+    tmpfs_size=None,
+    pool=None,
+    posix_spawn=False,
+):
+    """
+    The steps of `testfile`, as a generator for `_run_steps` or
+    `_run_steps_async`.
+    """
     if package and not module_relative:
         raise ValueError("Package may only be specified for module-" "relative paths.")
 
@@ -964,21 +3172,246 @@ def testfile(
         globs["__name__"] = "__main__"
 
     runner = ScriptDocTestRunner(
-        verbose=verbose, optionflags=optionflags, base_path=base_path
+        verbose=verbose,
+        optionflags=optionflags,
+        base_path=base_path,
+        snapshot=snapshot,
+        track_changes=track_changes,
+        session=session,
+        section_jobs=section_jobs,
+        checkpoints=checkpoints,
+        early_abort=early_abort,
+        timeout=timeout,
+        memory_limit=memory_limit,
+        cpu_limit=cpu_limit,
+        listeners=listeners,
+        budget=budget,
+        document_budget=document_budget,
+        over_budget=over_budget,
+        template=template,
+        tmpfs=tmpfs,
+        tmpfs_size=tmpfs_size,
+        pool=pool,
+        posix_spawn=posix_spawn,
     )
 
-    # Read the file, convert it to a test, and run it.
-    test = parser.get_doctest(text, globs, name, filename, 0)
-    runner.run(test)
+    if cache is not None:
+        key = cache.key(
+            text,
+            optionflags,
+            session=session,
+            timeout=timeout,
+            memory_limit=memory_limit,
+            cpu_limit=cpu_limit,
+            budget=budget,
+            document_budget=document_budget,
+            over_budget=over_budget,
+            template=template
+            and (os.path.abspath(template), cache.tree_digest(template)),
+        )
+        cached = yield _BLOCKING, "call", [cache.get, key], {}
+    else:
+        cached = None
+
+    if cached is not None:
+        if runner._verbose:
+            (out or sys.stdout.write)(
+                "%s: cached pass, %d tests\n" % (name, cached["tries"])
+            )
+        runner.record_outcome(name, 0, cached["tries"])
+    else:
+        # Read the file, convert it to a test, and run it.
+        if parse_cache is not None:
+            test = parse_cache.get_doctest(parser, text, globs, name, filename, 0)
+        else:
+            test = parser.get_doctest(text, globs, name, filename, 0)
+        yield runner, "run", [test], {"out": out}
+        if cache is not None and not runner.failures:
+            yield _BLOCKING, "call", [cache.put, key, name, runner.tries], {}
 
     if report:
         runner.summarize()
 
-    if master is None:
-        master = runner
+    return TestResults(runner.failures, runner.tries)
+
+
+def find_documents(paths, pattern="*.rst"):
+    """
+    Return the files in `paths`: Files are taken as they are,
+    directories are searched recursively for files matching the glob
+    `pattern`, in sorted order.
+    """
+    documents = []
+    for path in paths:
+        if not os.path.isdir(path):
+            documents.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(fnmatch.filter(filenames, pattern)):
+                documents.append(os.path.join(dirpath, filename))
+    return documents
+
+
+def _testfile_job(filename, kwargs):
+    """Run `testfile` with a buffered report, for `testfiles`."""
+    report = []
+    results = testfile(filename, report=False, out=report.append, **kwargs)
+    # The listeners are copies in this process; send them back.
+    return results, "".join(report), kwargs.get("listeners")
+
+
+def _testfile_options(documents, i, base_path, verbose, kwargs):
+    """
+    Return the arguments of `testfile` for the `i`th of `documents`,
+    for `testfiles` and `testfiles_async`.
+    """
+    filename = documents[i]
+    options = dict(kwargs, module_relative=False, name=filename, verbose=verbose)
+    if base_path is not None and len(documents) > 1:
+        os.makedirs(base_path, exist_ok=True)
+        options["base_path"] = os.path.join(base_path, str(i))
+    else:
+        options["base_path"] = base_path
+    return options
+
+
+def testfiles(
+    paths,
+    jobs=1,
+    fail_fast=False,
+    pattern="*.rst",
+    verbose=None,
+    report=True,
+    base_path=None,
+    **kwargs
+):
+    """
+    Test the examples in many files.  Return (#failures, #tests) over
+    all of them.
+
+    `paths` are files and directories to search for files matching the
+    glob `pattern`, see `find_documents`. Each file is run by
+    `testfile`, with `module_relative=False`, the path as its name,
+    and any further keyword arguments.
+
+    Optional keyword arg "jobs" gives the number of files tested at
+    the same time, in separate processes; 0 means one per CPU. The
+    report of each file is written at once, when it is finished.
+
+    Optional keyword arg "fail_fast" stops testing files as soon as
+    one of them failed.
+
+    Optional keyword arg "base_path" gives a directory in which each
+    file gets its own workspace (a numbered subdirectory). If there
+    is only one file, it is used as the workspace itself.
+
+    Optional keyword arg "report" prints a summary of all files at the
+    end when true.
+    """
+    documents = find_documents(paths, pattern)
+    if not jobs:
+        jobs = os.cpu_count() or 1
+
+    def job(i, filename):
+        return filename, _testfile_options(documents, i, base_path, verbose, kwargs)
+
+    if kwargs.get("cache") is not None:
+        # Hash the dependencies once, not in every worker.
+        kwargs["cache"].dependency_digest()
+        if kwargs.get("template"):
+            kwargs["cache"].tree_digest(kwargs["template"])
+
+    runner = ScriptDocTestRunner(verbose=verbose)
+
+    def record(filename, future):
+        results, output, listeners = future.result()
+        for listener, remote in zip(kwargs.get("listeners") or (), listeners or ()):
+            listener.merge(remote)
+        sys.stdout.write(output)
+        sys.stdout.flush()
+        runner.record_outcome(filename, results.failed, results.attempted)
+        return results.failed
+
+    if jobs == 1 or len(documents) <= 1:
+        for i, filename in enumerate(documents):
+            filename, options = job(i, filename)
+            results = testfile(filename, report=False, **options)
+            runner.record_outcome(filename, results.failed, results.attempted)
+            if results.failed and fail_fast:
+                break
     else:
-        master.merge(runner)
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            futures = {}
+            for i, filename in enumerate(documents):
+                filename, options = job(i, filename)
+                futures[executor.submit(_testfile_job, filename, options)] = filename
+            for future in concurrent.futures.as_completed(futures):
+                if future.cancelled():
+                    continue
+                if record(futures[future], future) and fail_fast:
+                    for pending in futures:
+                        pending.cancel()
 
+    if report:
+        return runner.summarize()
+    return TestResults(runner.failures, runner.tries)
+
+
+async def testfiles_async(
+    paths,
+    concurrency=100,
+    fail_fast=False,
+    pattern="*.rst",
+    verbose=None,
+    report=True,
+    base_path=None,
+    **kwargs
+):
+    """
+    Like `testfiles`, with the same arguments, but a coroutine, which
+    tests up to `concurrency` files at the same time on the running
+    event loop (see `testfile_async`) rather than in processes.  This
+    suits many files whose examples mostly wait.  The report of each
+    file is written at once, when it is finished.
+    """
+    documents = find_documents(paths, pattern)
+
+    if kwargs.get("cache") is not None:
+        # Hash the dependencies once, not for every file.
+        kwargs["cache"].dependency_digest()
+        if kwargs.get("template"):
+            kwargs["cache"].tree_digest(kwargs["template"])
+
+    runner = ScriptDocTestRunner(verbose=verbose)
+    limit = asyncio.Semaphore(concurrency)
+    stopped = asyncio.Event()
+
+    async def job(i, filename):
+        options = _testfile_options(documents, i, base_path, verbose, kwargs)
+        async with limit:
+            if stopped.is_set():
+                return
+            report = []
+            results = await testfile_async(
+                filename, report=False, out=report.append, **options
+            )
+        sys.stdout.write("".join(report))
+        sys.stdout.flush()
+        runner.record_outcome(filename, results.failed, results.attempted)
+        if results.failed and fail_fast:
+            stopped.set()
+
+    tasks = [asyncio.ensure_future(job(i, filename)) for i, filename in enumerate(documents)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if report:
+        return runner.summarize()
     return TestResults(runner.failures, runner.tries)
 
 
@@ -986,7 +3419,35 @@ if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="")
-    parser.add_argument("filename")
+    parser.add_argument(
+        "filename",
+        nargs="+",
+        help="documents to test, or directories to search for them",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of documents to test in parallel (0: one per CPU)",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        default=False,
+        help="stop testing documents after the first one that failed",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        metavar="N",
+        help="test up to N documents at the same time on an asyncio event loop, instead of in --jobs processes",
+    )
+    parser.add_argument(
+        "--pattern",
+        default="*.rst",
+        help="glob for the documents to test in directories (default: *.rst)",
+    )
     parser.add_argument("--base_path")
     parser.add_argument("--module_relative", action="store_true", default=False)
     parser.add_argument("--name", default=None)
@@ -1011,6 +3472,172 @@ if __name__ == "__main__":
     parser.add_argument("--raise_on_error", action="store_true", default=False)
     parser.add_argument("--parser", default=ScriptDocTestParser())
     parser.add_argument("--encoding", default=None)
+    parser.add_argument(
+        "--snapshot",
+        nargs="?",
+        const=True,
+        default=False,
+        metavar="PATH",
+        help="report the files changed by each example, optionally only those below PATH",
+    )
+    parser.add_argument(
+        "--track-changes",
+        action="store_true",
+        default=False,
+        help="find changed files using inotify instead of walking the workspace",
+    )
+    parser.add_argument(
+        "--template",
+        metavar="DIR",
+        help="start each workspace with a copy of the files in this directory",
+    )
+    parser.add_argument(
+        "--tmpfs",
+        nargs="?",
+        const="/dev/shm",
+        default=None,
+        metavar="DIR",
+        help="create the workspaces in RAM, in DIR (default: /dev/shm)",
+    )
+    parser.add_argument(
+        "--tmpfs-size",
+        type=int,
+        default=256,
+        metavar="MB",
+        help="move workspaces from RAM to disk when they grow beyond this (default: 256)",
+    )
+    parser.add_argument(
+        "--workspace-pool",
+        action="store_true",
+        default=False,
+        help="prepare workspaces ahead of time and delete them in the background",
+    )
+    parser.add_argument(
+        "--posix-spawn",
+        action="store_true",
+        default=False,
+        help="start examples with posix_spawn instead of fork, where possible",
+    )
+    parser.add_argument(
+        "--session",
+        action="store_true",
+        default=False,
+        help="run all examples of a document in one persistent shell",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="skip documents that passed before, caching results in this directory",
+    )
+    parser.add_argument(
+        "--cache-env",
+        action="append",
+        default=[],
+        metavar="NAME",
+        help="environment variable that is part of the cache key (repeatable)",
+    )
+    parser.add_argument(
+        "--cache-dep",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help="file, directory or program whose contents are part of the cache key (repeatable)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        default=False,
+        help="run all documents, even those with a cached pass",
+    )
+    parser.add_argument(
+        "--prune-cache",
+        type=float,
+        default=None,
+        metavar="DAYS",
+        help="remove cache entries not used for this many days",
+    )
+    parser.add_argument(
+        "--parse-cache",
+        default=None,
+        metavar="DIR",
+        help="cache the examples parsed from documents in this directory",
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        default=None,
+        help="save the workspace after each example here, and resume from the last unchanged one",
+    )
+    parser.add_argument(
+        "--early-abort",
+        action="store_true",
+        default=False,
+        help="kill examples as soon as their output can no longer match",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        help="kill and fail examples that take longer than this",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=int,
+        metavar="MB",
+        help="limit the address space of every process an example starts",
+    )
+    parser.add_argument(
+        "--cpu-limit",
+        type=int,
+        metavar="SECONDS",
+        help="limit the CPU time of every process an example starts",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        default=False,
+        help="print how much time the examples spent in each phase",
+    )
+    parser.add_argument(
+        "--durations",
+        type=int,
+        default=None,
+        metavar="N",
+        help="print the N slowest examples and documents",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        metavar="SECONDS",
+        help="fail examples that take longer than this (but let them finish)",
+    )
+    parser.add_argument(
+        "--document-budget",
+        type=float,
+        metavar="SECONDS",
+        help="fail documents whose examples take longer than this together",
+    )
+    parser.add_argument(
+        "--budget-warn",
+        action="store_true",
+        default=False,
+        help="only warn about examples and documents over their budget",
+    )
+    parser.add_argument(
+        "--jsonl",
+        metavar="FILE",
+        help="write a JSON record of each example to this file as it finishes",
+    )
+    parser.add_argument(
+        "--junit-xml",
+        metavar="FILE",
+        help="write a JUnit XML report of the examples to this file",
+    )
+    parser.add_argument(
+        "--section-jobs",
+        type=int,
+        default=1,
+        help="number of sections of a document to run in parallel",
+    )
     args = parser.parse_args()
     options = 0
     for option in args.option:
@@ -1021,11 +3648,18 @@ if __name__ == "__main__":
         else:
             options |= OPTIONFLAGS_BY_NAME[option]
 
-    results = testfile(
-        filename=args.filename,
-        module_relative=args.module_relative,
-        name=args.name,
-        package=args.package,
+    cache = None
+    if args.cache_dir:
+        cache = ResultCache(
+            args.cache_dir,
+            environ=args.cache_env,
+            dependencies=args.cache_dep,
+            force=args.force,
+        )
+        if args.prune_cache is not None:
+            cache.prune(args.prune_cache * 24 * 60 * 60)
+
+    kwargs = dict(
         globs=args.globs,
         verbose=args.verbose,
         report=args.report,
@@ -1035,6 +3669,65 @@ if __name__ == "__main__":
         parser=args.parser,
         encoding=args.encoding,
         base_path=args.base_path,
+        snapshot=args.snapshot,
+        track_changes=args.track_changes,
+        session=args.session,
+        section_jobs=args.section_jobs,
+        cache=cache,
+        checkpoints=args.checkpoint_dir and CheckpointStore(args.checkpoint_dir),
+        early_abort=args.early_abort,
+        timeout=args.timeout,
+        memory_limit=args.memory_limit and args.memory_limit << 20,
+        cpu_limit=args.cpu_limit,
+        parse_cache=args.parse_cache and ParseCache(args.parse_cache),
+        listeners=[],
+        budget=args.budget,
+        document_budget=args.document_budget,
+        over_budget="warn" if args.budget_warn else "fail",
+        template=args.template,
+        tmpfs=args.tmpfs,
+        tmpfs_size=args.tmpfs_size << 20,
+        pool=scripttest.WorkspacePool() if args.workspace_pool else None,
+        posix_spawn=args.posix_spawn,
     )
+    if args.durations is not None:
+        kwargs["listeners"].append(SlowestExamples(args.durations))
+    if args.timings:
+        kwargs["listeners"].append(PhaseBreakdown())
+    if args.jsonl:
+        kwargs["listeners"].append(JSONLinesReporter(args.jsonl))
+    if args.junit_xml:
+        kwargs["listeners"].append(JUnitReporter(args.junit_xml))
+    if len(args.filename) == 1 and not os.path.isdir(args.filename[0]):
+        results = testfile(
+            filename=args.filename[0],
+            module_relative=args.module_relative,
+            name=args.name,
+            package=args.package,
+            **kwargs
+        )
+    elif args.concurrency:
+        results = asyncio.run(
+            testfiles_async(
+                args.filename,
+                concurrency=args.concurrency,
+                fail_fast=args.fail_fast,
+                pattern=args.pattern,
+                **kwargs
+            )
+        )
+    else:
+        results = testfiles(
+            args.filename,
+            jobs=args.jobs,
+            fail_fast=args.fail_fast,
+            pattern=args.pattern,
+            **kwargs
+        )
+    for listener in kwargs["listeners"]:
+        listener.close()
+        listener.report()
+    if kwargs["pool"] is not None:
+        kwargs["pool"].close()
     if results.failed:
         sys.exit(1)
@@ -5,14 +5,42 @@
 Helpers for testing command-line scripts
 """
 import sys
+import asyncio
+import functools
 import tempfile
 import os
 import shutil
 import shlex
+import select
+import selectors
+import signal
 import subprocess
 import re
+import binascii
+import errno
+import itertools
+import struct
+import threading
+import time
+import types
 import zlib
 
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
 
 if sys.platform == 'win32':
     def clean_environ(e):
@@ -59,6 +87,72 @@ def onerror(func, path, exc_info):
 
 __all__ = ['TestFileEnvironment']
 
+# From <linux/fs.h>
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    """
+    Copy the file ``src`` (with its permissions and times) to ``dst``.
+    Where the filesystem supports it, the copy is a reflink, which
+    shares the data blocks with ``src`` until either is modified.
+    """
+    if fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            pass
+        else:
+            shutil.copystat(src, dst)
+            return
+    shutil.copy2(src, dst)
+
+
+def tmpfs_available(path, size):
+    """
+    Return whether the directory ``path`` exists, is writable and has
+    at least ``size`` bytes free.
+    """
+    try:
+        st = os.statvfs(path)
+    except (OSError, AttributeError):
+        return False
+    return os.access(path, os.W_OK) and st.f_bavail * st.f_frsize >= size
+
+
+def clone_tree(src, dst, link_readonly=True):
+    """
+    Copy the directory tree ``src`` into the directory ``dst``, which
+    is created if needed.  Files are copied with `clone_file`, and
+    symlinks as links.  If ``link_readonly`` is true (default), files
+    that nobody may write are hard linked instead, where possible; a
+    command that makes such a file writable again modifies ``src``.
+    """
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel = os.path.relpath(dirpath, src)
+        target_dir = os.path.normpath(os.path.join(dst, rel))
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        for dirname in list(dirnames):
+            if os.path.islink(os.path.join(dirpath, dirname)):
+                # Copied as a link, not followed.
+                dirnames.remove(dirname)
+                filenames.append(dirname)
+        for filename in filenames:
+            full = os.path.join(dirpath, filename)
+            target = os.path.join(target_dir, filename)
+            if os.path.islink(full):
+                os.symlink(os.readlink(full), target)
+                continue
+            if link_readonly and not os.stat(full).st_mode & 0o222:
+                try:
+                    os.link(full, target)
+                    continue
+                except OSError:
+                    pass
+            clone_file(full, target)
+
 if sys.platform == 'win32':
     def full_executable_path(invoked, environ):
 
@@ -106,6 +200,399 @@ else:
     from subprocess import Popen
 
 
+def kill_group(proc):
+    """
+    Kill whatever is left of the process group of ``proc``, which
+    must have been started with ``start_new_session=True``.
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def limit_resources(memory_limit=None, cpu_limit=None):
+    """
+    Return a ``preexec_fn`` for ``Popen`` that limits the address
+    space of the child to ``memory_limit`` bytes and its CPU time to
+    ``cpu_limit`` seconds, or ``None`` if there is nothing to limit.
+    """
+    if memory_limit is None and cpu_limit is None:
+        return None
+    if resource is None:
+        raise TypeError(
+            'Resource limits are not supported on this platform')
+    limits = []
+    if memory_limit is not None:
+        limits.append((resource.RLIMIT_AS, int(memory_limit)))
+    if cpu_limit is not None:
+        limits.append((resource.RLIMIT_CPU, int(cpu_limit)))
+
+    def preexec():
+        for which, value in limits:
+            resource.setrlimit(which, (value, value))
+    return preexec
+
+
+def communicate(proc, input=None, watch=None, timeout=None):
+    """
+    Like ``proc.communicate(input, timeout)``, for a ``proc`` that
+    leads its own process group (``start_new_session=True``), but pass
+    each chunk of stdout to ``watch`` as soon as it is read.  If
+    ``watch`` returns ``False``, kill ``proc`` and stop reading.
+
+    Once ``proc`` exits (or times out), the rest of its process group
+    is killed, so background processes that keep the pipes open do
+    not keep this waiting.  On a timeout, `subprocess.TimeoutExpired`
+    is raised with the output read so far.
+
+    Returns ``(stdout, stderr, aborted)``.
+    """
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+    selector = selectors.DefaultSelector()
+    chunks = {}
+    for stream in proc.stdout, proc.stderr:
+        if stream is not None:
+            selector.register(stream, selectors.EVENT_READ)
+            chunks[stream] = []
+    if proc.stdin is not None:
+        if input:
+            selector.register(proc.stdin, selectors.EVENT_WRITE)
+            input = memoryview(input)
+        else:
+            proc.stdin.close()
+    # Learn when ``proc`` exits from a pidfd where possible, or else by
+    # polling now and then.
+    pidfd = None
+    if hasattr(os, 'pidfd_open'):
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+            selector.register(pidfd, selectors.EVENT_READ)
+        except OSError:
+            pidfd = None
+    exited = False
+    aborted = timed_out = False
+    while selector.get_map() and not aborted:
+        wait = None if pidfd is not None or exited else 0.1
+        if timeout is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                timed_out = True
+                break
+            wait = remaining if wait is None else min(wait, remaining)
+        ready = selector.select(wait)
+        if not exited and (pidfd is None or any(
+                key.fileobj == pidfd for key, events in ready)):
+            if proc.poll() is not None:
+                exited = True
+                kill_group(proc)
+                if pidfd is not None:
+                    selector.unregister(pidfd)
+        for key, events in ready:
+            stream = key.fileobj
+            if stream == pidfd:
+                continue
+            if stream is proc.stdin:
+                try:
+                    input = input[os.write(stream.fileno(), input[:1 << 16]):]
+                except BrokenPipeError:
+                    input = None
+                if not input:
+                    selector.unregister(stream)
+                    stream.close()
+                continue
+            data = os.read(stream.fileno(), 1 << 16)
+            if not data:
+                selector.unregister(stream)
+                continue
+            chunks[stream].append(data)
+            if (stream is proc.stdout and watch is not None
+                    and watch(data) is False):
+                aborted = True
+                break
+    selector.close()
+    if pidfd is not None:
+        os.close(pidfd)
+    kill_group(proc)
+    for stream in proc.stdin, proc.stdout, proc.stderr:
+        if stream is not None:
+            stream.close()
+    proc.wait()
+    kill_group(proc)
+    stdout = b''.join(chunks[proc.stdout])
+    stderr = b''.join(chunks[proc.stderr]) if proc.stderr else None
+    if timed_out:
+        raise subprocess.TimeoutExpired(
+            proc.args, timeout, output=stdout, stderr=stderr)
+    return stdout, stderr, aborted
+
+
+async def communicate_async(proc, input=None, watch=None, timeout=None):
+    """
+    Like `communicate`, for a ``proc`` started by
+    ``asyncio.create_subprocess_exec``: The event loop runs other
+    tasks while this waits for output.  If this is cancelled, what is
+    left of ``proc`` is killed.
+
+    Returns ``(stdout, stderr, aborted)``, or raises
+    `subprocess.TimeoutExpired`.
+    """
+    def kill():
+        if sys.platform == 'win32':
+            if proc.returncode is None:
+                proc.kill()
+        else:
+            kill_group(proc)
+
+    async def read(stream, chunks, watch=None):
+        # Returns whether ``watch`` aborted.
+        while True:
+            data = await stream.read(1 << 16)
+            if not data:
+                return False
+            chunks.append(data)
+            if watch is not None and watch(data) is False:
+                return True
+
+    async def write():
+        try:
+            if input:
+                proc.stdin.write(input)
+                await proc.stdin.drain()
+            proc.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    async def wait():
+        # Once ``proc`` exits, background processes that keep the
+        # pipes open must not keep this waiting.  (``proc.wait()``
+        # waits for the pipes, too.)  Learn of the exit from a pidfd
+        # where possible, or else by polling now and then.
+        pidfd = None
+        if hasattr(os, 'pidfd_open'):
+            try:
+                pidfd = os.pidfd_open(proc.pid)
+            except OSError:
+                pidfd = None
+        try:
+            if pidfd is not None:
+                exited = loop.create_future()
+                loop.add_reader(pidfd, lambda: exited.done()
+                                or exited.set_result(None))
+                try:
+                    await exited
+                finally:
+                    loop.remove_reader(pidfd)
+            else:
+                while proc.returncode is None:
+                    await asyncio.sleep(0.1)
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
+        kill()
+
+    loop = asyncio.get_running_loop()
+    stdout, stderr = [], []
+    readers = [asyncio.ensure_future(read(proc.stdout, stdout, watch))]
+    if proc.stderr is not None:
+        readers.append(asyncio.ensure_future(read(proc.stderr, stderr)))
+    helpers = [asyncio.ensure_future(wait())]
+    if proc.stdin is not None:
+        helpers.append(asyncio.ensure_future(write()))
+    if timeout is not None:
+        deadline = loop.time() + timeout
+    aborted = timed_out = False
+    try:
+        pending = set(readers)
+        while pending:
+            remaining = None
+            if timeout is not None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    timed_out = True
+                    break
+            done, pending = await asyncio.wait(
+                pending, timeout=remaining,
+                return_when=asyncio.FIRST_COMPLETED)
+            if readers[0] in done and readers[0].result():
+                aborted = True
+                break
+    finally:
+        kill()
+        for task in readers + helpers:
+            task.cancel()
+        await asyncio.gather(*readers + helpers, return_exceptions=True)
+        if proc.returncode is None:
+            await proc.wait()
+    stdout = b''.join(stdout)
+    stderr = b''.join(stderr) if proc.stderr is not None else None
+    if timed_out:
+        raise subprocess.TimeoutExpired(
+            getattr(proc, 'args', None), timeout,
+            output=stdout, stderr=stderr)
+    return stdout, stderr, aborted
+
+
+# From <spawn.h> (glibc)
+POSIX_SPAWN_SETSIGDEF = 0x04
+POSIX_SPAWN_SETSIGMASK = 0x08
+POSIX_SPAWN_SETSID = 0x80
+
+_spawn_libc = None
+
+
+def _load_spawn_libc():
+    """
+    Return the C library, set up for `posix_spawn`, or ``None`` if
+    it lacks the functions (they need glibc 2.29 or later).
+    """
+    global _spawn_libc
+    if _spawn_libc is None:
+        _spawn_libc = False
+        if ctypes is not None and sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                   use_errno=True)
+                libc.posix_spawn_file_actions_adddup2.argtypes = [
+                    ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+                libc.posix_spawn_file_actions_addchdir_np.argtypes = [
+                    ctypes.c_void_p, ctypes.c_char_p]
+                libc.posix_spawnattr_setflags.argtypes = [
+                    ctypes.c_void_p, ctypes.c_short]
+                libc.posix_spawn.argtypes = [
+                    ctypes.POINTER(ctypes.c_int), ctypes.c_char_p,
+                    ctypes.c_void_p, ctypes.c_void_p,
+                    ctypes.POINTER(ctypes.c_char_p),
+                    ctypes.POINTER(ctypes.c_char_p)]
+            except (OSError, AttributeError, TypeError):
+                pass
+            else:
+                _spawn_libc = libc
+    return _spawn_libc or None
+
+
+def environ_block(environ):
+    """
+    Return ``environ`` as a C array of ``NAME=value`` strings, for
+    `posix_spawn`.
+    """
+    entries = [os.fsencode(k) + b'=' + os.fsencode(v)
+               for k, v in environ.items()]
+    return (ctypes.c_char_p * (len(entries) + 1))(*entries)
+
+
+def posix_spawn(args, executable, cwd, envp, err_to_out=False):
+    """
+    Start ``args`` (running the file ``executable``) in the directory
+    ``cwd``, with the environment ``envp`` (see `environ_block`), in
+    a new session, with its stdin, stdout and stderr connected to
+    pipes, like ``Popen(..., start_new_session=True)``.  If
+    ``err_to_out`` is true, stderr goes to the stdout pipe.
+
+    Unlike ``Popen``, the C library starts the process without
+    copying the parent's memory, which takes the same time however
+    large the parent is.  Returns a `SpawnedProcess`.
+    """
+    libc = _load_spawn_libc()
+    # Large enough for posix_spawn_file_actions_t, posix_spawnattr_t
+    # and sigset_t.
+    actions = ctypes.create_string_buffer(1024)
+    attr = ctypes.create_string_buffer(1024)
+    sigdefault = ctypes.create_string_buffer(1024)
+    sigmask = ctypes.create_string_buffer(1024)
+    child_fds = []
+    parent_fds = []
+    try:
+        for reads in True, False, False:
+            if not reads and err_to_out and len(child_fds) == 2:
+                child_fds.append(child_fds[1])
+                parent_fds.append(None)
+                continue
+            r, w = os.pipe()
+            child_fds.append(r if reads else w)
+            parent_fds.append(w if reads else r)
+        libc.posix_spawn_file_actions_init(actions)
+        libc.posix_spawnattr_init(attr)
+        try:
+            for target, fd in enumerate(child_fds):
+                libc.posix_spawn_file_actions_adddup2(actions, fd, target)
+            libc.posix_spawn_file_actions_addchdir_np(
+                actions, os.fsencode(cwd))
+            # Python ignores these; the child should not.
+            libc.sigemptyset(sigdefault)
+            libc.sigaddset(sigdefault, signal.SIGPIPE)
+            libc.sigaddset(sigdefault, signal.SIGXFSZ)
+            libc.sigemptyset(sigmask)
+            libc.posix_spawnattr_setsigdefault(attr, sigdefault)
+            libc.posix_spawnattr_setsigmask(attr, sigmask)
+            libc.posix_spawnattr_setflags(
+                attr, POSIX_SPAWN_SETSID | POSIX_SPAWN_SETSIGDEF |
+                POSIX_SPAWN_SETSIGMASK)
+            argv = (ctypes.c_char_p * (len(args) + 1))(
+                *[os.fsencode(arg) for arg in args])
+            pid = ctypes.c_int()
+            err = libc.posix_spawn(
+                ctypes.byref(pid), os.fsencode(executable), actions, attr,
+                argv, envp)
+        finally:
+            libc.posix_spawn_file_actions_destroy(actions)
+            libc.posix_spawnattr_destroy(attr)
+        if err:
+            raise OSError(err, os.strerror(err), executable)
+    except BaseException:
+        for fd in parent_fds:
+            if fd is not None:
+                os.close(fd)
+        raise
+    finally:
+        for fd in set(child_fds):
+            os.close(fd)
+    stdin, stdout, stderr = parent_fds
+    return SpawnedProcess(
+        args, pid.value, open(stdin, 'wb', 0), open(stdout, 'rb', 0),
+        open(stderr, 'rb', 0) if stderr is not None else None)
+
+
+class SpawnedProcess(object):
+
+    """
+    The part of the interface of ``subprocess.Popen`` that
+    `communicate` uses, for a process started by `posix_spawn`.
+    """
+
+    def __init__(self, args, pid, stdin, stdout, stderr):
+        self.args = args
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, 0)
+            self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+
+class SpawnError(OSError):
+
+    """
+    Raised by `TestFileEnvironment.run` when the script cannot be
+    started at all, eg. because it is not executable, as opposed to
+    errors after it ran.  Its ``errno``, ``strerror`` and ``filename``
+    are those of the failure.
+    """
+
+
 class TestFileEnvironment(object):
 
     """
@@ -121,7 +608,11 @@ class TestFileEnvironment(object):
     def __init__(self, base_path=None, template_path=None,
                  environ=None, cwd=None, start_clear=True,
                  ignore_paths=None, ignore_hidden=True,
-                 capture_temp=False, assert_no_temp=False, split_cmd=True):
+                 capture_temp=False, assert_no_temp=False, split_cmd=True,
+                 snapshot=True, track_changes=False, timeout=None,
+                 memory_limit=None, cpu_limit=None, listeners=None,
+                 tmpfs=None, tmpfs_size=None, pool=None,
+                 posix_spawn=False):
         """
         Creates an environment.  ``base_path`` is used as the current
         working directory, and generally where changes are looked for.
@@ -130,7 +621,8 @@ class TestFileEnvironment(object):
 
         ``template_path`` is the directory to look for *template*
         files, which are files you'll explicitly add to the
-        environment.  This is done with ``.writefile()``.
+        environment.  This is done with ``.writefile()``, or for the
+        whole directory with ``.seed()``.
 
         ``environ`` is the operating system environment,
         ``os.environ`` if not given.
@@ -149,6 +641,48 @@ class TestFileEnvironment(object):
         ``capture_temp`` will put temporary files inside the
         environment (using ``$TMPDIR``).  You can then assert that no
         temporary files are left using ``.assert_no_temp()``.
+
+        ``snapshot`` is the default snapshot policy of ``.run()``: if
+        true (default), all of ``base_path`` is walked before and
+        after each command, so the ``ProcResult`` can report created,
+        updated and deleted files.  If false, no walk happens and
+        those reports stay empty.  A path (relative to ``base_path``)
+        restricts the walk to that subtree.
+
+        If ``track_changes`` is true, full snapshots are kept up to
+        date from the Linux inotify events of ``base_path`` (see
+        `InotifyTracker`) instead of walking it around each command.
+        Where inotify is not available, or runs out of watches, the
+        walk is used.
+
+        ``timeout`` is the default number of seconds after which
+        ``.run()`` kills a command.  Commands are killed together
+        with all processes they leave behind in their process group.
+
+        ``memory_limit`` (in bytes, ``RLIMIT_AS``) and ``cpu_limit``
+        (in seconds, ``RLIMIT_CPU``) limit the resources of each
+        process a command starts.
+
+        ``listeners`` are objects whose ``command_timings(env, result,
+        timings)`` method is called after each command, with the
+        ``ProcResult`` and its ``timings`` (see there).
+
+        ``tmpfs`` is a directory in RAM, such as ``/dev/shm``, to
+        create the base directory in if no ``base_path`` is given.  It
+        is only used if it has ``tmpfs_size`` bytes free; otherwise the
+        base directory is created on disk, as without ``tmpfs``.  If
+        the files grow beyond ``tmpfs_size``, ``.spill()`` moves them
+        to disk.  ``in_ram`` tells where the base directory is.
+
+        ``pool`` is a `WorkspacePool`, which provides the base
+        directory if no ``base_path`` is given, and deletes the files
+        in the background when ``.clear()`` is called.
+
+        If ``posix_spawn`` is true, ``.run()`` starts commands with the
+        `posix_spawn` of the C library where it can (on Linux with
+        glibc 2.29 or later, without resource limits), instead of
+        ``subprocess.Popen``.  Its environment block is only rebuilt
+        when ``environ`` or the working directory has changed.
         """
         self.capture_temp = capture_temp
         if self.capture_temp:
@@ -159,8 +693,17 @@ class TestFileEnvironment(object):
 
         self.ignore_paths = ignore_paths or []
 
+        self.tmpfs_size = tmpfs_size
+        self.in_ram = False
+        self.pool = pool
         if base_path is None:
-            base_path = tempfile.mkdtemp()
+            if tmpfs and tmpfs_available(tmpfs, tmpfs_size or 0):
+                base_path = tempfile.mkdtemp(dir=tmpfs)
+                self.in_ram = True
+            elif pool is not None:
+                base_path = pool.acquire()
+            else:
+                base_path = tempfile.mkdtemp()
             open(os.path.join(
                 base_path, self.marker_file), "w").close()
             self.base_path = base_path
@@ -187,6 +730,15 @@ class TestFileEnvironment(object):
         self._assert_no_temp = assert_no_temp
 
         self.split_cmd = split_cmd
+        self.snapshot = snapshot
+        self.track_changes = track_changes
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit
+        self.listeners = list(listeners or ())
+        self.posix_spawn = posix_spawn
+        self._envp = self._envp_source = None
+        self._tracker = None
 
     def run(self, script, *args, **kw):
         """
@@ -205,28 +757,175 @@ class TestFileEnvironment(object):
         ``stdin``: (default ``""``)
             Input to the script
         ``cwd``: (default ``self.cwd``)
-            The working directory to run in (default ``base_path``)
+            The working directory to run in (default ``base_path``);
+            ``PWD`` is set to it in the script's environment
         ``quiet``: (default False)
             When there's an error (return code != 0), do not print
             stdout/stderr
+        ``snapshot``: (default ``self.snapshot``)
+            Which files to look at for changes: ``True`` for all of
+            ``base_path``, ``False`` for none, or a path relative to
+            ``base_path`` to only look at that subtree
+        ``watch``: (default None)
+            A function called with each chunk of stdout (as bytes) as
+            soon as it is read.  If it returns ``False``, the script is
+            killed, and the result is marked as ``aborted``.
+        ``timeout``: (default ``self.timeout``)
+            Seconds after which the script is killed, and the result
+            is marked as ``timed_out``
 
         Returns a `ProcResult
-        <class-paste.fixture.ProcResult.html>`_ object.
+        <class-paste.fixture.ProcResult.html>`_ object.  Raises
+        `SpawnError` if the script cannot be started.
         """
         __tracebackhide__ = True
-        expect_error = kw.pop('expect_error', False)
-        expect_stderr = kw.pop('expect_stderr', expect_error)
-        cwd = kw.pop('cwd', self.cwd)
-        stdin = kw.pop('stdin', None)
-        quiet = kw.pop('quiet', False)
-        debug = kw.pop('debug', False)
-        redirect = kw.pop('err_to_out', False)
+        call = self._prepare_run(script, args, kw)
+        script, all, debug = call.script, call.args, call.debug
+
+        clock = time.perf_counter
+        start = clock()
+        files_before, tracker = self._files_before(call.snapshot)
+        snapshotted = clock()
+
+        executable = None
+        if (self.posix_spawn and not debug
+                and self.memory_limit is None and self.cpu_limit is None
+                and _load_spawn_libc() is not None):
+            if os.sep in script:
+                executable = script
+            else:
+                executable = shutil.which(
+                    script, path=self.environ.get('PATH', os.defpath))
+
+        try:
+            if debug:
+                proc = subprocess.Popen(all,
+                                        cwd=call.cwd,
+                                        # see http://bugs.python.org/issue8557
+                                        shell=(sys.platform == 'win32'),
+                                        env=self._child_environ(call.cwd))
+            elif executable is not None:
+                proc = posix_spawn(
+                    all, executable, call.cwd, self._environ_block(call.cwd),
+                    call.redirect)
+            else:
+                proc = subprocess.Popen(all, stdin=subprocess.PIPE,
+                                        stderr=(subprocess.STDOUT if call.redirect else subprocess.PIPE),
+                                        stdout=subprocess.PIPE,
+                                        cwd=call.cwd,
+                                        # see http://bugs.python.org/issue8557
+                                        shell=(sys.platform == 'win32'),
+                                        env=self._child_environ(call.cwd),
+                                        start_new_session=(sys.platform != 'win32'),
+                                        preexec_fn=limit_resources(
+                                            self.memory_limit, self.cpu_limit))
+        except OSError as e:
+            raise SpawnError(e.errno, e.strerror, e.filename) from e
+        spawned = clock()
+
+        aborted = timed_out = False
+        if debug:
+            stdout, stderr = proc.communicate()
+        elif sys.platform != 'win32':
+            try:
+                stdout, stderr, aborted = communicate(
+                    proc, call.stdin, call.watch, call.timeout)
+            except subprocess.TimeoutExpired as e:
+                stdout, stderr, timed_out = e.output, e.stderr, True
+        else:
+            try:
+                stdout, stderr = proc.communicate(call.stdin, call.timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                stdout, stderr = proc.communicate()
+                timed_out = True
+        finished = clock()
+        stdout, stderr = self._clean_output(stdout, stderr, call.redirect)
+        read = clock()
+        files_after, changed = self._files_after(call.snapshot, tracker)
+        return self._finish_run(
+            call, proc.returncode, stdout, stderr, aborted, timed_out,
+            (files_before, files_after, changed),
+            (start, snapshotted, spawned, finished, read))
+
+    async def run_async(self, script, *args, **kw):
+        """
+        Like `run`, but a coroutine, so that an event loop can run
+        other tasks (eg. other scripts) while the script runs.  The
+        script is started with ``asyncio.create_subprocess_exec``
+        (``posix_spawn`` and ``debug`` do not apply), and the
+        snapshots are taken in a thread of the loop's default
+        executor.
+        """
+        __tracebackhide__ = True
+        call = self._prepare_run(script, args, kw)
+        loop = asyncio.get_running_loop()
+
+        clock = time.perf_counter
+        start = clock()
+        files_before, tracker = {}, None
+        if call.snapshot:
+            files_before, tracker = await loop.run_in_executor(
+                None, self._files_before, call.snapshot)
+        snapshotted = clock()
+
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *call.args, stdin=subprocess.PIPE,
+                stderr=(subprocess.STDOUT if call.redirect else subprocess.PIPE),
+                stdout=subprocess.PIPE,
+                cwd=call.cwd,
+                env=self._child_environ(call.cwd),
+                start_new_session=(sys.platform != 'win32'),
+                preexec_fn=limit_resources(self.memory_limit, self.cpu_limit))
+        except OSError as e:
+            raise SpawnError(e.errno, e.strerror, e.filename) from e
+        spawned = clock()
+
+        aborted = timed_out = False
+        try:
+            stdout, stderr, aborted = await communicate_async(
+                proc, call.stdin, call.watch, call.timeout)
+        except subprocess.TimeoutExpired as e:
+            stdout, stderr, timed_out = e.output, e.stderr, True
+        finished = clock()
+        stdout, stderr = self._clean_output(stdout, stderr, call.redirect)
+        read = clock()
+        files_after, changed = {}, None
+        if call.snapshot:
+            files_after, changed = await loop.run_in_executor(
+                None, self._files_after, call.snapshot, tracker)
+        return self._finish_run(
+            call, proc.returncode, stdout, stderr, aborted, timed_out,
+            (files_before, files_after, changed),
+            (start, snapshotted, spawned, finished, read))
+
+    def _prepare_run(self, script, args, kw):
+        """
+        Check the arguments of `run` (see there), and return them
+        as attributes of a namespace: ``script``, ``args`` (the whole
+        command line), ``cwd``, ``stdin``, ``quiet``, ``debug``,
+        ``redirect``, ``snapshot``, ``watch``, ``timeout``,
+        ``expect_error``, ``expect_stderr`` and ``expect_temp``.
+        """
+        __tracebackhide__ = True
+        call = types.SimpleNamespace()
+        call.expect_error = kw.pop('expect_error', False)
+        call.expect_stderr = kw.pop('expect_stderr', call.expect_error)
+        call.cwd = kw.pop('cwd', self.cwd)
+        call.stdin = kw.pop('stdin', None)
+        call.quiet = kw.pop('quiet', False)
+        call.debug = kw.pop('debug', False)
+        call.redirect = kw.pop('err_to_out', False)
+        call.snapshot = kw.pop('snapshot', self.snapshot)
+        call.watch = kw.pop('watch', None)
+        call.timeout = kw.pop('timeout', self.timeout)
         if not self.temp_path:
             if 'expect_temp' in kw:
                 raise TypeError(
                     'You cannot use expect_temp unless you use '
                     'capture_temp=True')
-        expect_temp = kw.pop('expect_temp', not self._assert_no_temp)
+        call.expect_temp = kw.pop('expect_temp', not self._assert_no_temp)
         args = list(map(str, args))
         assert not kw, (
             "Arguments not expected: %s" % ', '.join(kw.keys()))
@@ -238,50 +937,129 @@ class TestFileEnvironment(object):
                 script, args = script.split(None, 1)
                 args = shlex.split(args)
 
-        all = [script] + args
-
-        files_before = self._find_files()
+        call.script = script
+        call.args = [script] + args
+        return call
 
-        if debug:
-            proc = subprocess.Popen(all,
-                                    cwd=cwd,
-                                    # see http://bugs.python.org/issue8557
-                                    shell=(sys.platform == 'win32'),
-                                    env=clean_environ(self.environ.copy()))
-        else:
-            proc = subprocess.Popen(all, stdin=subprocess.PIPE,
-                                    stderr=(subprocess.STDOUT if redirect else subprocess.PIPE),
-                                    stdout=subprocess.PIPE,
-                                    cwd=cwd,
-                                    # see http://bugs.python.org/issue8557
-                                    shell=(sys.platform == 'win32'),
-                                    env=clean_environ(self.environ.copy()))
-
-        if debug:
-            stdout, stderr = proc.communicate()
-        else:
-            stdout, stderr = proc.communicate(stdin)
-        stdout = string(stdout)
+    @staticmethod
+    def _clean_output(stdout, stderr, redirect):
+        # ``stdout`` is decoded by the result, when it is needed.
+        stdout = stdout.replace(b'\r\n', b'\n')
         stderr = "" if redirect else string(stderr)
-
-        stdout = string(stdout).replace('\r\n', '\n')
         stderr = string(stderr).replace('\r\n', '\n')
-        files_after = self._find_files()
+        return stdout, stderr
+
+    def _finish_run(self, call, returncode, stdout, stderr, aborted,
+                    timed_out, files, times):
+        """
+        Return the `ProcResult` of a script that `run` or `run_async`
+        ran, as prepared by ``_prepare_run``, with its ``files``
+        before and after (and those that may have changed) and the
+        ``times`` at which its phases ended.
+        """
+        __tracebackhide__ = True
+        files_before, files_after, changed = files
+        start, snapshotted, spawned, finished, read = times
+        snapshotted_after = time.perf_counter()
         result = ProcResult(
-            self, all, stdin, stdout, stderr,
-            returncode=proc.returncode,
+            self, call.args, call.stdin, stdout, stderr,
+            returncode=returncode,
             files_before=files_before,
-            files_after=files_after)
-        if not expect_error:
-            result.assert_no_error(quiet)
-        if not expect_stderr:
-            result.assert_no_stderr(quiet)
-        if not expect_temp:
-            result.assert_no_temp(quiet)
+            files_after=files_after,
+            changed=changed)
+        result.aborted = aborted
+        result.timed_out = timed_out
+        result.timings = {
+            'snapshot_before': snapshotted - start,
+            'spawn': spawned - snapshotted,
+            'command': finished - spawned,
+            'output': read - finished,
+            'snapshot_after': snapshotted_after - read,
+            'diff': time.perf_counter() - snapshotted_after,
+        }
+        for listener in self.listeners:
+            listener.command_timings(self, result, result.timings)
+        if not call.expect_error:
+            result.assert_no_error(call.quiet)
+        if not call.expect_stderr:
+            result.assert_no_stderr(call.quiet)
+        if not call.expect_temp:
+            result.assert_no_temp(call.quiet)
         return result
 
-    def _find_files(self):
+    def _child_environ(self, cwd):
+        """
+        Return the environment for a script run in ``cwd``: ``environ``,
+        with ``PWD`` set to ``cwd``, as a shell would set it.
+        """
+        environ = self.environ.copy()
+        environ['PWD'] = os.path.abspath(cwd)
+        return clean_environ(environ)
+
+    def _environ_block(self, cwd):
+        if self._envp is None or self._envp_source != (self.environ, cwd):
+            self._envp_source = (dict(self.environ), cwd)
+            self._envp = environ_block(self._child_environ(cwd))
+        return self._envp
+
+    def session(self, shell='/bin/sh'):
+        """
+        Start a `ShellSession`, which runs scripts one after the other
+        in the same ``shell`` process.
+        """
+        return ShellSession(self, shell)
+
+    def _files_before(self, snapshot):
+        """Return the files before running a command under the given
+        snapshot policy, and the tracker to pass to ``_files_after``"""
+        tracker = self._get_tracker() if snapshot is True else None
+        if tracker is not None:
+            try:
+                return tracker.files_before(), tracker
+            except TrackerUnavailable:
+                self._drop_tracker()
+                return self._find_files(), None
+        return self._snapshot(snapshot), None
+
+    def _files_after(self, snapshot, tracker):
+        """Return the files after running a command, and the set of
+        paths that may have changed (``None`` if unknown)"""
+        if tracker is not None:
+            try:
+                return tracker.files_after()
+            except TrackerUnavailable:
+                self._drop_tracker()
+                return self._find_files(), None
+        return self._snapshot(snapshot), None
+
+    def _get_tracker(self):
+        if self.track_changes and self._tracker is None:
+            try:
+                self._tracker = InotifyTracker(self)
+            except TrackerUnavailable:
+                self.track_changes = False
+        return self._tracker
+
+    def _drop_tracker(self):
+        if self._tracker is not None:
+            self._tracker.close()
+            self._tracker = None
+        self.track_changes = False
+
+    def _snapshot(self, snapshot):
+        if not snapshot:
+            return {}
+        if snapshot is True or os.path.normpath(snapshot) == os.curdir:
+            return self._find_files()
+        return self._find_files(snapshot)
+
+    def _find_files(self, subtree=None):
         result = {}
+        if subtree is not None:
+            subtree = os.path.normpath(subtree)
+            if os.path.lexists(os.path.join(self.base_path, subtree)):
+                self._find_traverse(subtree, result)
+            return result
         for fn in os.listdir(self.base_path):
             if self._ignore_file(fn):
                 continue
@@ -310,7 +1088,9 @@ class TestFileEnvironment(object):
 
     def clear(self, force=False):
         """
-        Delete all the files in the base directory.
+        Delete all the files in the base directory.  With a ``pool``,
+        the directory is only renamed aside, and deleted in the
+        background.
         """
         if os.path.exists(self.base_path):
             if not force and not os.path.exists(os.path.join(
@@ -325,12 +1105,84 @@ class TestFileEnvironment(object):
                 raise AssertionError(
                     "The directory %s was not created by ScriptTest; it must "
                     "be deleted manually" % self.base_path)
-            shutil.rmtree(self.base_path, onerror=onerror)
+            if self.pool is not None:
+                self.pool.discard(self.base_path)
+            else:
+                shutil.rmtree(self.base_path, onerror=onerror)
         os.mkdir(self.base_path)
         open(os.path.join(self.base_path, self.marker_file), "w").close()
         if self.temp_path and not os.path.exists(self.temp_path):
             os.makedirs(self.temp_path)
 
+    def close(self):
+        """
+        Release the inotify instance of ``track_changes``, when the
+        environment is no longer used; the files are left alone.
+        """
+        self._drop_tracker()
+
+    def disk_usage(self):
+        """
+        Return the number of bytes in the files of the base directory.
+        """
+        total = 0
+        stack = [self.base_path]
+        while stack:
+            for entry in os.scandir(stack.pop()):
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    total += entry.stat(follow_symlinks=False).st_size
+        return total
+
+    def _tmpfs_used(self):
+        """
+        Return the bytes used on the filesystem of the base directory,
+        which no workspace on it can exceed, without walking the tree.
+        """
+        st = os.statvfs(self.base_path)
+        return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+    def spill(self, force=False):
+        """
+        Move the base directory from RAM to a new temporary directory
+        on disk if it holds more than ``tmpfs_size`` bytes (or in any
+        case, if ``force`` is true).  The working directory moves along.
+        Return whether it was moved.
+
+        Processes running in the base directory, such as a shell
+        `session`, keep working in the old one.
+        """
+        if not self.in_ram:
+            return False
+        if not force and (self.tmpfs_size is None
+                          or self._tmpfs_used() <= self.tmpfs_size
+                          or self.disk_usage() <= self.tmpfs_size):
+            return False
+        old = self.base_path
+        new = tempfile.mkdtemp()
+        clone_tree(old, new, link_readonly=False)
+        shutil.rmtree(old, onerror=onerror)
+        if self._tracker is not None:
+            self._tracker.close()
+            self._tracker = None
+        self.base_path = new
+        self.cwd = os.path.join(new, os.path.relpath(self.cwd, old))
+        self.in_ram = False
+        return True
+
+    def seed(self, template_path=None, link_readonly=True):
+        """
+        Copy all files of ``template_path`` (by default
+        ``self.template_path``) into the base directory, see
+        `clone_tree`.  Where the filesystem supports reflinks, this
+        takes about the same time for large files as for small ones.
+        """
+        template_path = template_path or self.template_path
+        if not template_path:
+            raise TypeError('No template_path to seed from')
+        clone_tree(template_path, self.base_path, link_readonly)
+
     def writefile(self, path, content=None,
                   frompath=None):
         """
@@ -341,14 +1193,17 @@ class TestFileEnvironment(object):
         full = os.path.join(self.base_path, path)
         if not os.path.exists(os.path.dirname(full)):
             os.makedirs(os.path.dirname(full))
+        if frompath is not None and self.template_path:
+            frompath = os.path.join(self.template_path, frompath)
+        if content is None and frompath is not None:
+            clone_file(frompath, full)
+            return FoundFile(self.base_path, path)
         f = open(full, 'wb')
         if content is not None:
             f.write(content)
         if frompath is not None:
-            if self.template_path:
-                frompath = os.path.join(self.template_path, frompath)
             f2 = open(frompath, 'rb')
-            f.write(f2.read())
+            shutil.copyfileobj(f2, f)
             f2.close()
         f.close()
         return FoundFile(self.base_path, path)
@@ -374,6 +1229,560 @@ class TestFileEnvironment(object):
             % ', '.join(sorted(names)))
 
 
+class ShellSession(object):
+
+    """
+    A shell process that stays alive to run several scripts of a
+    `TestFileEnvironment`, so that changes of the working directory,
+    variables and functions persist from one script to the next.
+
+    Each script is ``eval``-ed by the shell, with its standard input
+    from ``/dev/null`` and its standard error merged into standard
+    output.  The shell then prints a unique sentinel with the exit
+    status and working directory, which ends the script's output.
+    ``.run()`` keeps ``env.cwd`` up to date with that working
+    directory.
+
+    If a script makes the shell exit, the next script starts a new
+    shell (in ``env.cwd``).  Output that background processes print
+    after their script finished ends up in the output of a later one.
+    Such processes share the process group of the shell, so they are
+    only killed when the session is closed (or a script times out).
+    """
+
+    def __init__(self, env, shell='/bin/sh'):
+        self.env = env
+        self.shell = shell
+        self.proc = None
+        self._token = '\x1escriptdoctest-%s' % binascii.hexlify(
+            os.urandom(8)).decode('ascii')
+        self._count = 0
+        self._pending = b''
+        # Errors of the shell itself mention the ``eval``; drop that,
+        # so they look like those of ``sh -c``.
+        self._eval_prefix = re.compile(
+            br'^(%s: (?:\d+: )?)eval: ' % re.escape(os.fsencode(shell)),
+            re.MULTILINE)
+
+    def start(self):
+        self.proc = Popen([self.shell], stdin=subprocess.PIPE,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT,
+                          cwd=self.env.cwd,
+                          env=self.env._child_environ(self.env.cwd),
+                          start_new_session=True,
+                          preexec_fn=limit_resources(
+                              self.env.memory_limit, self.env.cpu_limit))
+
+    def close(self):
+        """Stop the shell, and everything left in its process group."""
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except (OSError, ValueError):
+                pass
+            self.proc.stdout.close()
+            self.proc.wait()
+            kill_group(self.proc)
+            self.proc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def run(self, script, snapshot=None, watch=None, timeout=None):
+        """
+        Run ``script`` in the shell, and return a `ProcResult`.
+        ``snapshot``, ``watch`` and ``timeout`` are as for
+        ``TestFileEnvironment.run()``; if ``watch`` aborts the script,
+        or it times out, the shell is killed (with its process group),
+        and the next script starts a new one.
+        """
+        env = self.env
+        if snapshot is None:
+            snapshot = env.snapshot
+        if timeout is None:
+            timeout = env.timeout
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        clock = time.perf_counter
+        start = clock()
+        if self.proc is None or self.proc.poll() is not None:
+            self.start()
+        spawned = clock()
+        self._count += 1
+        sentinel = '%s-%d' % (self._token, self._count)
+        command = "command eval %s </dev/null; printf '%%s %%d %%s\\n' %s \"$?\" \"$PWD\"\n" % (
+            shlex.quote(script), shlex.quote(sentinel))
+
+        files_before, tracker = env._files_before(snapshot)
+        snapshotted = clock()
+
+        fd = self.proc.stdout.fileno()
+        try:
+            self.proc.stdin.write(command.encode('utf-8'))
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            pass
+        sentinel = sentinel.encode('utf-8')
+        data, self._pending = self._pending, b''
+        # data[:watched] is output, and has been passed to ``watch``.
+        watched = 0
+        pos = -1
+        aborted = timed_out = False
+        while True:
+            if pos < 0:
+                pos = data.find(sentinel, watched)
+                end = pos
+                if pos < 0:
+                    # The sentinel may have been split between chunks:
+                    # hold back a tail that may be its start.  (Its
+                    # first byte occurs nowhere else in it.)
+                    end = len(data)
+                    start = data.rfind(sentinel[:1], max(
+                        watched, len(data) - len(sentinel) + 1))
+                    if start >= 0 and sentinel.startswith(data[start:]):
+                        end = start
+                if watch is not None and end > watched:
+                    aborted = watch(data[watched:end]) is False
+                watched = end
+            if aborted or timed_out:
+                kill_group(self.proc)
+                stdout = data[:watched]
+                returncode = self.proc.wait()
+                self.close()
+                break
+            if pos >= 0:
+                newline = data.find(b'\n', pos)
+                if newline >= 0:
+                    stdout = data[:pos]
+                    status, cwd = data[
+                        pos + len(sentinel) + 1:newline].split(b' ', 1)
+                    returncode = int(status)
+                    env.cwd = os.fsdecode(cwd)
+                    # Keep anything printed after the sentinel for later.
+                    self._pending = data[newline + 1:]
+                    break
+            if timeout is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select(
+                        [fd], [], [], remaining)[0]:
+                    timed_out = True
+                    continue
+            chunk = os.read(fd, 1 << 16)
+            if not chunk:
+                # The shell exited.
+                stdout = data
+                returncode = self.proc.wait()
+                self.close()
+                break
+            data += chunk
+        finished = clock()
+
+        stdout = stdout.replace(b'\r\n', b'\n')
+        stdout = self._eval_prefix.sub(br'\1', stdout)
+        read = clock()
+        files_after, changed = env._files_after(snapshot, tracker)
+        snapshotted_after = clock()
+        result = ProcResult(
+            env, [self.shell, script], None, stdout, '',
+            returncode=returncode,
+            files_before=files_before,
+            files_after=files_after,
+            changed=changed)
+        result.aborted = aborted
+        result.timed_out = timed_out
+        result.timings = {
+            'snapshot_before': snapshotted - spawned,
+            'spawn': spawned - start,
+            'command': finished - snapshotted,
+            'output': read - finished,
+            'snapshot_after': snapshotted_after - read,
+            'diff': clock() - snapshotted_after,
+        }
+        for listener in env.listeners:
+            listener.command_timings(env, result, result.timings)
+        return result
+
+    async def run_async(self, script, snapshot=None, watch=None,
+                        timeout=None):
+        """
+        Like ``.run()``, but a coroutine, which waits for the shell in
+        a thread of the event loop's default executor.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(
+                self.run, script, snapshot=snapshot, watch=watch,
+                timeout=timeout))
+
+
+class WorkspacePool(object):
+
+    """
+    Workspaces for `TestFileEnvironment`, created ahead of time and
+    deleted in the background, so that starting an environment does
+    not wait for ``mkdtemp`` or ``shutil.rmtree``.
+
+    The workspaces are created in ``directory`` (by default a new
+    temporary directory), up to ``size`` of them in advance.  A
+    discarded workspace is renamed into ``directory`` (or next to
+    where it is, if that is another filesystem) and deleted by a
+    background thread.  The interpreter waits for that thread before
+    it exits; ``.wait()`` waits for it earlier.  Left over discarded
+    workspaces, eg. of a killed run, are deleted when a pool is
+    created in the same ``directory``.
+    """
+
+    def __init__(self, directory=None, size=2):
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='scripttest-pool-')
+        elif not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.size = size
+        self._ready = []
+        self._trash = [os.path.join(directory, name)
+                       for name in os.listdir(directory)
+                       if name.startswith('trash-')]
+        self._lock = threading.Lock()
+        self._worker = None
+        self._counter = itertools.count()
+        self._start()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('_lock', '_worker', '_counter'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        # A copy in a worker process: the prepared workspaces belong
+        # to the original, and it only runs one document.
+        self.__dict__.update(state)
+        self.size = 0
+        self._ready = []
+        self._trash = []
+        self._lock = threading.Lock()
+        self._worker = None
+        self._counter = itertools.count()
+
+    def _make(self):
+        path = tempfile.mkdtemp(prefix='ws-', dir=self.directory)
+        open(os.path.join(path, TestFileEnvironment.marker_file),
+             'w').close()
+        return path
+
+    def _start(self):
+        with self._lock:
+            if self._worker is None and (
+                    self._trash or len(self._ready) < self.size):
+                self._worker = threading.Thread(
+                    target=self._work, name='scripttest-workspaces')
+                self._worker.start()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if len(self._ready) < self.size:
+                    path = None
+                elif self._trash:
+                    path = self._trash.pop(0)
+                else:
+                    self._worker = None
+                    return
+            if path is None:
+                path = self._make()
+                with self._lock:
+                    # Unless the pool was closed meanwhile.
+                    if len(self._ready) < self.size:
+                        self._ready.append(path)
+                        path = None
+            if path is not None:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def acquire(self):
+        """
+        Return the path of an empty workspace, marked as created by
+        ScriptTest.
+        """
+        with self._lock:
+            path = self._ready.pop() if self._ready else None
+        if path is None:
+            path = self._make()
+        self._start()
+        return path
+
+    def discard(self, path):
+        """
+        Rename the directory ``path`` aside, and delete it in the
+        background.
+        """
+        name = 'trash-%d-%d' % (os.getpid(), next(self._counter))
+        trash = os.path.join(self.directory, name)
+        try:
+            os.rename(path, trash)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            trash = '%s.%s' % (path.rstrip(os.sep), name)
+            os.rename(path, trash)
+        with self._lock:
+            self._trash.append(trash)
+        self._start()
+
+    def wait(self):
+        """
+        Wait until the discarded workspaces are deleted.
+        """
+        while True:
+            with self._lock:
+                worker = self._worker
+            if worker is None:
+                return
+            worker.join()
+
+    def close(self):
+        """
+        Delete the prepared workspaces, wait for all deletions, and
+        remove ``directory`` if it is empty.
+        """
+        with self._lock:
+            self.size = 0
+            ready, self._ready = self._ready, []
+        for path in ready:
+            self.discard(path)
+        self.wait()
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            pass
+
+
+class TrackerUnavailable(Exception):
+
+    """
+    Raised when changes cannot (or can no longer) be tracked using
+    inotify.
+    """
+
+
+class InotifyTracker(object):
+
+    """
+    Keeps the files below the ``base_path`` of a `TestFileEnvironment`
+    up to date from Linux inotify events, so that finding the changes
+    made by a command costs time proportional to the number of
+    changes, not to the size of the tree.
+
+    ``files_before()`` returns the files (as ``_find_files()`` would)
+    before running a command; ``files_after()`` the files after
+    running it, together with the set of paths that may have changed.
+
+    Raises `TrackerUnavailable` if inotify cannot be used, eg. because
+    the platform does not have it or the watch limit is reached.
+    """
+
+    # From <sys/inotify.h>
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                  IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR)
+    # Events that change the listing, and thus the mtime, of the
+    # directory they happen in.
+    LISTING_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    _event = struct.Struct('iIII')
+    _libc = None
+
+    def __init__(self, env):
+        self.env = env
+        self.fd = None
+        libc = self._load_libc()
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise TrackerUnavailable(os.strerror(ctypes.get_errno()))
+        # watch descriptor <-> directory path relative to base_path
+        self.wds = {}
+        self.paths = {}
+        self.files = {}
+        try:
+            self._watch('')
+            for fn in os.listdir(env.base_path):
+                if not env._ignore_file(fn):
+                    self._add(fn, set())
+        except TrackerUnavailable:
+            self.close()
+            raise
+
+    @classmethod
+    def _load_libc(cls):
+        if cls._libc is None:
+            if not sys.platform.startswith('linux') or ctypes is None:
+                raise TrackerUnavailable('inotify is only available on Linux')
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                   use_errno=True)
+                libc.inotify_init1.argtypes = [ctypes.c_int]
+                libc.inotify_add_watch.argtypes = [
+                    ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+                libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+            except (OSError, AttributeError) as e:
+                raise TrackerUnavailable(str(e))
+            cls._libc = libc
+        return cls._libc
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _watch(self, path):
+        full = os.path.join(self.env.base_path, path)
+        wd = self._libc.inotify_add_watch(
+            self.fd, os.fsencode(full), self.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise TrackerUnavailable('inotify watch limit reached')
+            # The directory is gone already; its events tell us so.
+            return
+        # Symbolic links may make a directory show up at several paths.
+        self.wds.setdefault(wd, set()).add(path)
+        self.paths[path] = wd
+
+    def _add(self, path, changed):
+        """Record ``path``, which exists, and everything below it."""
+        env = self.env
+        full = os.path.join(env.base_path, path)
+        changed.add(path)
+        if os.path.isdir(full):
+            if not env.temp_path or path != 'tmp':
+                self.files[path] = FoundDir(env.base_path, path)
+            # Watch before listing, so nothing created in between is lost.
+            self._watch(path)
+            for fn in os.listdir(full):
+                fn = os.path.join(path, fn)
+                if not env._ignore_file(fn):
+                    self._add(fn, changed)
+        else:
+            self.files[path] = FoundFile(env.base_path, path)
+
+    def _remove(self, path, changed):
+        """Forget ``path`` and everything below it."""
+        if self.files.pop(path, None) is not None:
+            changed.add(path)
+        prefix = path + os.sep
+        for p in [p for p in self.files if p.startswith(prefix)]:
+            del self.files[p]
+            changed.add(p)
+        for p in [p for p in self.paths
+                  if p == path or p.startswith(prefix)]:
+            wd = self.paths.pop(p)
+            aliases = self.wds.get(wd, set())
+            aliases.discard(p)
+            # A directory moved within the tree keeps its watch.
+            if not aliases and wd in self.wds:
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self.wds[wd]
+
+    def _read_events(self):
+        """Return the paths touched by the pending events, or ``None``
+        if the event queue overflowed."""
+        dirty = set()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = self._event.unpack_from(data, pos)
+                pos += self._event.size
+                name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+                pos += length
+                if mask & self.IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & self.IN_IGNORED:
+                    for directory in self.wds.pop(wd, ()):
+                        self.paths.pop(directory, None)
+                    continue
+                for directory in self.wds.get(wd, ()):
+                    if name:
+                        dirty.add(os.path.join(directory, name))
+                        if mask & self.LISTING_MASK and directory:
+                            dirty.add(directory)
+                    elif directory:
+                        dirty.add(directory)
+        if overflow:
+            return None
+        return dirty
+
+    def _update(self):
+        """Apply the pending events to ``self.files``. Return the set
+        of changed paths, or ``None`` if everything was re-read."""
+        dirty = self._read_events()
+        if dirty is None:
+            for wd in list(self.wds):
+                self._libc.inotify_rm_watch(self.fd, wd)
+            self.wds = {}
+            self.paths = {}
+            self.files = {}
+            self._watch('')
+            for fn in os.listdir(self.env.base_path):
+                if not self.env._ignore_file(fn):
+                    self._add(fn, set())
+            return None
+        env = self.env
+        changed = set()
+        # Parents sort before their children.
+        for path in sorted(dirty):
+            if self._ignored(path):
+                continue
+            full = os.path.join(env.base_path, path)
+            if not os.path.lexists(full):
+                self._remove(path, changed)
+            elif os.path.isdir(full) and path in self.paths:
+                # Its contents have events of their own.
+                if path in self.files:
+                    self.files[path] = FoundDir(env.base_path, path)
+                    changed.add(path)
+            elif path in self.files and not self.files[path].dir:
+                self.files[path] = FoundFile(env.base_path, path)
+                changed.add(path)
+            else:
+                self._remove(path, changed)
+                self._add(path, changed)
+        return changed
+
+    def _ignored(self, path):
+        while path:
+            if self.env._ignore_file(path):
+                return True
+            path = os.path.dirname(path)
+        return False
+
+    def files_before(self):
+        self._update()
+        return self.files.copy()
+
+    def files_after(self):
+        changed = self._update()
+        return self.files.copy(), changed
+
+
 class ProcResult(object):
 
     """
@@ -386,6 +1795,10 @@ class ProcResult(object):
     ``stdout``, ``stderr``:
         What is produced on those streams.
 
+    ``stdout_bytes``:
+        ``stdout`` before decoding, or ``None`` if it was passed in as
+        text.  ``stdout`` is only decoded when it is first used.
+
     ``returncode``:
         The return code of the script.
 
@@ -393,32 +1806,77 @@ class ProcResult(object):
         Dictionaries mapping filenames (relative to the ``base_path``)
         to `FoundFile <class-paste.fixture.FoundFile.html>`_ or
         `FoundDir <class-paste.fixture.FoundDir.html>`_ objects.
+
+    ``aborted``:
+        Whether the script was killed because its ``watch`` function
+        said so.
+
+    ``timed_out``:
+        Whether the script was killed because it ran into its
+        ``timeout``.
+
+    ``timings``:
+        A dictionary of the seconds spent in each phase of running the
+        script: ``snapshot_before``, ``spawn``, ``command`` (running
+        it and reading its output), ``output`` (preparing the output),
+        ``snapshot_after`` and ``diff`` (finding the changed files).
     """
 
+    aborted = False
+    timed_out = False
+    timings = {}
+
     def __init__(self, test_env, args, stdin, stdout, stderr,
-                 returncode, files_before, files_after):
+                 returncode, files_before, files_after, changed=None):
         self.test_env = test_env
         self.args = args
         self.stdin = stdin
-        self.stdout = stdout
+        if isinstance(stdout, bytes):
+            self.stdout_bytes = stdout
+            self._stdout = None
+        else:
+            self.stdout = stdout
         self.stderr = stderr
         self.returncode = returncode
         self.files_before = files_before
         self.files_after = files_after
         self.files_deleted = {}
         self.files_updated = {}
-        self.files_created = files_after.copy()
-        for path, f in files_before.items():
-            if path not in files_after:
-                self.files_deleted[path] = f
-                continue
-            del self.files_created[path]
-            if f != files_after[path]:
-                self.files_updated[path] = files_after[path]
+        if changed is None:
+            self.files_created = files_after.copy()
+            for path, f in files_before.items():
+                if path not in files_after:
+                    self.files_deleted[path] = f
+                    continue
+                del self.files_created[path]
+                if f != files_after[path]:
+                    self.files_updated[path] = files_after[path]
+        else:
+            # Only the paths in ``changed`` can differ.
+            self.files_created = {}
+            for path in changed:
+                if path not in files_before:
+                    if path in files_after:
+                        self.files_created[path] = files_after[path]
+                elif path not in files_after:
+                    self.files_deleted[path] = files_before[path]
+                elif files_before[path] != files_after[path]:
+                    self.files_updated[path] = files_after[path]
         if sys.platform == 'win32':
             self.stdout = self.stdout.replace('\n\r', '\n')
             self.stderr = self.stderr.replace('\n\r', '\n')
 
+    @property
+    def stdout(self):
+        if self._stdout is None:
+            self._stdout = string(self.stdout_bytes)
+        return self._stdout
+
+    @stdout.setter
+    def stdout(self, stdout):
+        self._stdout = stdout
+        self.stdout_bytes = None
+
     def assert_no_error(self, quiet):
         __tracebackhide__ = True
         if self.returncode != 0:
@@ -483,6 +1941,13 @@ class ProcResult(object):
         if self.stdout:
             s.append('-- stdout: --------------------')
             s.append(self.stdout)
+        s.extend(self.files_report())
+        return '\n'.join(s)
+
+    def files_report(self):
+        """Return the lines describing the created, deleted and
+        updated files, as used by ``str()``."""
+        s = []
         for name, files, show_size in [
                 ('created', self.files_created, True),
                 ('deleted', self.files_deleted, True),
@@ -502,7 +1967,7 @@ class ProcResult(object):
                         if show_size and f.size != 'N/A':
                             t += '  (%s bytes)' % f.size
                     s.append(t)
-        return '\n'.join(s)
+        return s
 
 
 class FoundFile(object):
@@ -531,6 +1996,10 @@ class FoundFile(object):
     ``size``:
         The size (in bytes) of the file.
 
+    ``hash``:
+        A checksum of the contents of the file.  It is only computed
+        when first needed, see ``__eq__``.
+
     You may use the ``in`` operator with these objects (tested against
     the contents of the file), and the ``.mustcontain()`` method.
     """
@@ -539,23 +2008,49 @@ class FoundFile(object):
     dir = False
     invalid = False
 
+    # Files modified less than this many seconds before they were found
+    # may be modified again without a visible change of their
+    # modification time, so their contents are checksummed right away.
+    racy_window = 2.0
+
+    chunk_size = 1 << 20
+
     def __init__(self, base_path, path):
         self.base_path = base_path
         self.path = path
         self.full = os.path.join(base_path, path)
+        self._hash = None
+        self.racy = False
         if os.path.exists(self.full):
             self.stat = os.stat(self.full)
             self.mtime = self.stat.st_mtime
             self.size = self.stat.st_size
-            with open(self.full, "rb") as fp:
-                self.hash = zlib.crc32(fp.read())
+            self.signature = (
+                self.stat.st_size, self.stat.st_mtime_ns,
+                self.stat.st_ino, self.stat.st_ctime_ns)
+            if time.time() - self.mtime < self.racy_window:
+                self.racy = True
+                self._hash = self._checksum()
         else:
             self.invalid = True
             self.stat = self.mtime = None
             self.size = 'N/A'
-            self.hash = None
+            self.signature = None
         self._bytes = None
 
+    def _checksum(self):
+        crc = 0
+        with open(self.full, "rb") as fp:
+            for chunk in iter(lambda: fp.read(self.chunk_size), b""):
+                crc = zlib.crc32(chunk, crc)
+        return crc
+
+    def hash__get(self):
+        if self._hash is None and not self.invalid:
+            self._hash = self._checksum()
+        return self._hash
+    hash = property(hash__get)
+
     def bytes__get(self):
         if self._bytes is None:
             f = open(self.full, 'rb')
@@ -581,14 +2076,27 @@ class FoundFile(object):
             self.base_path, self.path)
 
     def __eq__(self, other):
+        """Files are equal if they have the same size, modification
+        time, inode and change time, or, if a file was modified too
+        shortly before it was found to trust its modification time,
+        the same size, modification time and contents.
+
+        Only the contents of such files are checksummed when they are
+        found; a file found later with the same modification time was
+        such a file before.  Other files are not read, so a file that
+        was rewritten with the same size and modification time counts
+        as changed, even if its contents are the same.
+        """
         if not isinstance(other, FoundFile):
             return NotImplemented
 
-        return (
-            self.hash == other.hash and
-            self.mtime == other.mtime and
-            self.size == other.size
-        )
+        if self.invalid or other.invalid:
+            return self.invalid == other.invalid
+        if self.signature[:2] != other.signature[:2]:
+            return False
+        if not self.racy and not other.racy:
+            return self.signature == other.signature
+        return self.hash == other.hash
 
     def __ne__(self, other):
         return not self == other
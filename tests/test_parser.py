@@ -0,0 +1,140 @@
+"""
+Differential test of `ScriptDocTestParser`: It must find the same
+examples as the parser did with its original, backtracking
+`_EXAMPLE_RE`, on generated reference pages and on many small random
+documents.
+
+    python -m pytest tests
+"""
+
+import os
+import random
+import re
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from scriptdoctest import ScriptDocTestParser  # noqa
+
+
+class BacktrackingParser(ScriptDocTestParser):
+    """The parser as it was, finding examples with the original regex."""
+
+    _EXAMPLE_RE = re.compile(
+        r"""(
+        ::[ \n]*
+        (?P<example>
+            (?:^(?P<indent> [ ]*) \$[ ] .*\n)  # PS1 line
+            (?:((?P=indent)       .*      \n)|
+               ([ ]*                      \n))*)
+        \n?
+        )|(
+        ^(?P<preindent> [ ]*) ::\n
+        (?P<options>(
+            ([ ]*\n)|
+            (?P=preindent)[#] .*\n)*)
+        (?P<content>
+            ((?P<fullindent> (?P=preindent)[ ]+).*\n)*)
+        \n?
+        (?P=preindent) ---? [ ]* (?P<filename> .*)$
+        )""",
+        re.MULTILINE | re.VERBOSE,
+    )
+
+
+def document(size):
+    """Generate a reference page of about `size` characters."""
+    parts = []
+    total = i = 0
+    while total < size:
+        part = (
+            "Command %d\n"
+            "----------\n\n"
+            "Run it like this::\n\n"
+            "    $ tool --option %d input.txt  # doctest: +ELLIPSIS\n"
+            "    > --continued\n"
+            "    Result: [...]\n"
+            "    $ echo done\n"
+            "    done\n\n"
+            ".. scriptdoctest: section\n\n"
+            "  ::\n"
+            "  # doctest: +SKIP\n\n"
+            "    line one of file %d\n"
+            "    line two\n\n"
+            "  -- file%d.txt\n\n"
+            "Some text:: with colons, and more text.\n\n" % (i, i, i, i)
+        )
+        parts.append(part)
+        total += len(part)
+        i += 1
+    return "".join(parts)
+
+
+def unnamed_file(lines):
+    """Generate a file construction of `lines` lines without a name."""
+    return "Intro\n\n  ::\n\n" + "      content\n" * lines + "\nno name\n"
+
+
+PIECES = [
+    "::", "::\n", "  ::\n", "\n", "\n\n", "  ", "    ", "$ ", "$ echo a\n",
+    "> b\n", "out\n", "-- f\n", "--- g\n", "  -- h\n", "# x\n", "  # y\n",
+    "text", "-", "#", ".. scriptdoctest: section\n", "$",
+]
+
+
+def random_document(rng):
+    return "".join(rng.choice(PIECES) for _ in range(rng.randint(0, 25)))
+
+
+def examples(parser, string):
+    """Parse `string`, as comparable tuples, or the error raised."""
+    try:
+        return [
+            piece
+            if isinstance(piece, str)
+            else (
+                piece.source,
+                piece.want,
+                piece.exc_msg,
+                piece.lineno,
+                piece.indent,
+                piece.options,
+                piece.settings,
+                piece.section,
+            )
+            for piece in parser.parse(string, "<test>")
+        ]
+    except Exception as e:
+        return repr(e)
+
+
+class ParserTest(unittest.TestCase):
+    def assertSameExamples(self, string):
+        self.assertEqual(
+            examples(ScriptDocTestParser(), string),
+            examples(BacktrackingParser(), string),
+            "The parsers disagree on %r" % string,
+        )
+
+    def test_reference_page(self):
+        self.assertSameExamples(document(1 << 16))
+
+    def test_unnamed_file(self):
+        self.assertSameExamples(unnamed_file(8))
+
+    def test_random_documents(self):
+        rng = random.Random(0)
+        for _ in range(20000):
+            self.assertSameExamples(random_document(rng))
+
+    def test_unnamed_file_is_linear(self):
+        # The backtracking regex takes minutes for 30 lines.
+        start = time.perf_counter()
+        ScriptDocTestParser().parse(unnamed_file(20000))
+        self.assertLess(time.perf_counter() - start, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()